@@ -265,10 +265,7 @@ def evaluate(tree, frame=None):
         
     if isStr(tree):
         return get(tree, frame)
-    
-    print("tree: " + str(tree))
-    print("frame: " + str(frame))
-    
+
     first_elem = tree[0]
     func = evaluate(first_elem, frame)
     if not callable(func):
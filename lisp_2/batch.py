@@ -0,0 +1,128 @@
+"""
+6.101 Lab:
+LISP Interpreter Part 2 -- batch runner
+
+Run with `python batch.py [-j WORKERS] FILE ...`.  Each file is evaluated in
+its own fresh frame on a pool of worker processes, and one line per file is
+printed in the order the files were given.
+"""
+
+#!/usr/bin/env python3
+import sys
+import time
+import argparse
+import multiprocessing
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+import lab
+
+
+class BatchResult:
+    """
+    What happened when one file ran: the (printed) value of its last
+    expression, or the name and message of the error it raised, plus how
+    long it took and the largest resident size of the worker that ran it.
+    Values are sent back as strings since Functions and their frames can't
+    be pickled.
+    """
+    def __init__(self, filename, value=None, error=None, message="", seconds=0.0, max_rss=None):
+        self.filename = filename
+        self.value = value
+        self.error = error
+        self.message = message
+        self.seconds = seconds
+        self.max_rss = max_rss
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __str__(self):
+        status = "ok" if self.ok else "error"
+        if self.ok:
+            outcome = self.value
+        else:
+            outcome = f"{self.error}: {self.message}" if self.message else self.error
+        memory = f" {self.max_rss / 2**20:7.1f} MiB" if self.max_rss else ""
+        return f"{status:<6}{self.seconds * 1000:10.2f} ms{memory}  {self.filename}  {outcome}"
+
+
+def max_rss():
+    if resource is None:
+        return None
+    # kilobytes on Linux, bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def limit_memory(limit):
+    """
+    Pool initializer: cap the worker's address space at limit bytes, so a
+    runaway script fails with a MemoryError instead of taking the machine
+    down with it.
+    """
+    if limit is not None and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def run_file(filename, use_cache=True):
+    """
+    Evaluate filename in a fresh frame and return a BatchResult.  Every
+    error is caught, so one bad script can't stop the rest of the batch.
+    """
+    start = time.perf_counter()
+    try:
+        value = lab.evaluate_file(filename, lab.make_initial_frame(), use_cache=use_cache)
+        result = BatchResult(filename, value=str(value))
+    except Exception as e:
+        result = BatchResult(filename, error=type(e).__name__, message=str(e))
+    result.seconds = time.perf_counter() - start
+    result.max_rss = max_rss()
+    return result
+
+
+def run_batch(filenames, workers=None, files_per_worker=20, memory_limit=None):
+    """
+    Yield a BatchResult for each of filenames, in order, as they finish.
+    Each worker process is replaced after files_per_worker files, so memory
+    left behind by earlier scripts (garbage cycles, a fragmented heap)
+    doesn't pile up, and memory_limit (bytes) caps each worker's address
+    space.
+    """
+    with multiprocessing.Pool(
+        workers,
+        initializer=limit_memory,
+        initargs=(memory_limit,),
+        maxtasksperchild=files_per_worker,
+    ) as pool:
+        yield from pool.imap(run_file, filenames)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate many Scheme files in parallel.")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of worker processes (default: one per CPU)")
+    parser.add_argument("--files-per-worker", type=int, default=20,
+                        help="replace each worker after this many files")
+    parser.add_argument("--memory-limit", type=int, default=None, metavar="MiB",
+                        help="largest address space a worker may use")
+    args = parser.parse_args()
+
+    memory_limit = args.memory_limit * 2**20 if args.memory_limit else None
+    start = time.perf_counter()
+    results = []
+    for result in run_batch(args.files, args.workers, args.files_per_worker, memory_limit):
+        print(result, flush=True)
+        results.append(result)
+    elapsed = time.perf_counter() - start
+
+    errors = sum(not result.ok for result in results)
+    busy = sum(result.seconds for result in results)
+    print(f"{len(results)} files, {errors} errors, {elapsed:.2f} s wall, "
+          f"{busy:.2f} s evaluating")
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,973 @@
+"""
+6.101 Lab:
+LISP Interpreter Part 2 -- benchmarks
+
+Run with `python bench.py [name ...]`; with no names, every benchmark runs.
+"""
+
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import shutil
+import subprocess
+import tempfile
+import tracemalloc
+
+import lab
+
+TEST_DIRECTORY = os.path.dirname(__file__)
+FILES_DIRECTORY = os.path.join(TEST_DIRECTORY, "test_files")
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__.removeprefix("bench_")] = func
+    return func
+
+
+def best_time(func, *args, repeat=3):
+    """
+    Run func(*args) repeat times and return (best wall-clock time, result).
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def read_test_file(fname):
+    with open(os.path.join(FILES_DIRECTORY, fname)) as f:
+        return f.read()
+
+
+def scaled_source(source, copies):
+    """
+    Wrap copies of source in a single (begin ...) so it parses as one
+    expression.
+    """
+    return "(begin\n" + "\n".join([source] * copies) + "\n)"
+
+
+def peak_memory(func, *args):
+    """
+    Run func(*args) under tracemalloc and return its peak allocation in bytes.
+    """
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def retained_memory(func, *args):
+    """
+    Bytes still allocated by func(*args) while its result is alive.
+    """
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+        del result
+
+
+def report(name, seconds, detail=""):
+    print(f"  {name:<40} {seconds * 1000:10.2f} ms  {detail}")
+
+
+#############################
+# Parsing #
+#############################
+
+@benchmark
+def bench_parse(copies=100):
+    print(f"parse (test_files scaled x{copies})")
+    for fname in sorted(os.listdir(FILES_DIRECTORY)):
+        if not fname.endswith(".scm"):
+            continue
+        tokens = lab.tokenize(scaled_source(read_test_file(fname), copies))
+        seconds, _ = best_time(lab.parse, tokens)
+        report(fname, seconds, f"{len(tokens)} tokens")
+
+    for depth in (100, 1_000, 5_000):
+        tokens = ["("] * depth + ["x"] + [")"] * depth
+        seconds, _ = best_time(lab.parse, tokens)
+        report(f"nesting depth {depth}", seconds, f"{len(tokens)} tokens")
+
+
+@benchmark
+def bench_compact(copies=100):
+    print(f"parse trees: lists vs compact(), test_files scaled x{copies}")
+    import pickle
+    for fname in sorted(os.listdir(FILES_DIRECTORY)):
+        if not fname.endswith(".scm"):
+            continue
+        # copies as separate top-level expressions, like one long program
+        tokens = lab.tokenize("\n".join([read_test_file(fname)] * copies))
+        parse = lambda: list(lab.parse_stream(tokens))
+        def parse_compact():
+            nodes = {}
+            return [lab.compact(expr, nodes) for expr in lab.parse_stream(tokens)]
+        trees = parse()
+        compacted = parse_compact()
+        lists, tuples = retained_memory(parse) / 1024, retained_memory(parse_compact) / 1024
+        report(f"{fname}, parse", best_time(parse)[0], f"{lists:8.0f} KiB, "
+               f"pickled {len(pickle.dumps(trees, pickle.HIGHEST_PROTOCOL)) / 1024:6.0f} KiB")
+        report(f"{fname}, parse + compact", best_time(parse_compact)[0], f"{tuples:8.0f} KiB, "
+               f"pickled {len(pickle.dumps(compacted, pickle.HIGHEST_PROTOCOL)) / 1024:6.0f} KiB")
+        compile_all = lambda exprs: [lab.compile_expr(expr) for expr in exprs]
+        report(f"{fname}, compile lists", best_time(compile_all, trees)[0])
+        report(f"{fname}, compile compact", best_time(compile_all, compacted)[0])
+
+
+@benchmark
+def bench_tokenize(copies=500):
+    print(f"tokenize (sudoku.scm, {copies} top-level copies in one file)")
+    with tempfile.NamedTemporaryFile("w", suffix=".scm", delete=False) as f:
+        f.write("\n".join([read_test_file("sudoku.scm")] * copies))
+    try:
+        def whole():
+            with open(f.name) as file:
+                return len(lab.tokenize(file.read()))
+
+        def streamed():
+            with open(f.name) as file:
+                return sum(1 for _ in lab.tokenize_stream(file))
+
+        def first_expression():
+            with open(f.name) as file:
+                return next(lab.parse_stream(lab.tokenize_stream(file)))
+
+        for name, func in [("read + tokenize", whole), ("tokenize_stream", streamed)]:
+            seconds, count = best_time(func)
+            peak = peak_memory(func) / 2**20
+            report(name, seconds, f"{count} tokens, peak {peak:.1f} MiB")
+        seconds, _ = best_time(first_expression)
+        report("parse_stream to first expression", seconds)
+    finally:
+        os.unlink(f.name)
+
+
+#############################
+# Evaluation #
+#############################
+
+def read_session(n):
+    """
+    Top-level expressions of test_inputs/{n}.scm, one per line.
+    """
+    with open(os.path.join(TEST_DIRECTORY, "test_inputs", f"{n:02d}.scm")) as f:
+        return [lab.parse(lab.tokenize(line)) for line in f if line.strip()]
+
+
+def run_session(exprs):
+    frame = lab.make_initial_frame()
+    lab.evaluate_file(os.path.join(FILES_DIRECTORY, "map_filter_reduce.scm"), frame)
+    for expr in exprs:
+        try:
+            lab.evaluate(expr, frame)
+        except lab.SchemeError:
+            pass
+
+
+@benchmark
+def bench_eval():
+    print("evaluate (test sessions)")
+    for name, n in [("ndmines (test_inputs/65.scm)", 65), ("sudoku (test_inputs/66.scm)", 66)]:
+        seconds, _ = best_time(run_session, read_session(n), repeat=1)
+        report(name, seconds)
+
+
+@benchmark
+def bench_tail_calls(iterations=1_000_000):
+    print(f"tail-recursive loop ({iterations} iterations)")
+    frame = lab.make_initial_frame()
+    lab.evaluate(lab.parse(lab.tokenize(
+        "(define (loop n acc) (if (equal? n 0) acc (loop (- n 1) (+ acc 1))))"
+    )), frame)
+    expr = lab.parse(lab.tokenize(f"(loop {iterations} 0)"))
+    seconds, _ = best_time(lab.evaluate, expr, frame, repeat=1)
+    report("loop", seconds, f"{iterations / seconds:,.0f} iterations/s")
+
+
+def nested_lookup_program(depth, iterations, dynamic):
+    """
+    A loop that reads a variable bound depth scopes out.  With dynamic=True,
+    every scope also runs a define, which forces dict frames.
+    """
+    loop = (
+        "((lambda (loop) (loop loop {n} 0))"
+        " (lambda (self n acc) (if (equal? n 0) acc"
+        " (self self (- n 1) (+ acc x0 x0 x0 x0)))))"
+    ).format(n=iterations)
+    source = loop
+    for level in reversed(range(depth)):
+        body = f"(begin (define pad{level} 0) {source})" if dynamic else source
+        source = f"(let ((x{level} 1)) {body})"
+    return lab.parse(lab.tokenize(source))
+
+
+@benchmark
+def bench_lookup(iterations=20_000):
+    print(f"variable lookup vs nesting depth ({iterations} iterations, 4 reads each)")
+    for depth in (1, 5, 10, 20):
+        for dynamic in (False, True):
+            expr = nested_lookup_program(depth, iterations, dynamic)
+            seconds, _ = best_time(lab.evaluate, expr)
+            kind = "dict frames" if dynamic else "slot frames"
+            report(f"depth {depth:>2}, {kind}", seconds)
+
+
+@benchmark
+def bench_fold(iterations=20_000):
+    print(f"constant folding ({iterations} iterations of a loop full of constants)")
+    program = [lab.parse(lab.tokenize(line)) for line in [
+        "(define (loop n acc) (if (equal? n 0) acc"
+        " (loop (- n 1) (+ acc (* 60 60 24) (if (< 1 2) (/ 10 2) (- 1)) (and #t (> 3 2))))))",
+        f"(loop {iterations} 0)",
+    ]]
+    folded, count = lab.fold_program(program)
+    for name, trees in [("unfolded", program), (f"folded ({count} nodes)", folded)]:
+        def run():
+            frame = lab.make_initial_frame()
+            return [lab.evaluate(tree, frame) for tree in trees][-1]
+        seconds, _ = best_time(run)
+        report(name, seconds)
+    seconds, _ = best_time(lab.fold_program, read_session(65))
+    report("fold_program on test_inputs/65.scm", seconds)
+
+
+# the arithmetic builtins as they were before the numeric tower, to compare
+OLD_ARITHMETIC = {}
+
+def old_calc_sub(*args):
+    if len(args) == 1:
+        return -args[0]
+    first_num, *rest_nums = args
+    return first_num - OLD_ARITHMETIC['+'](*rest_nums)
+
+def old_calc_mult(*args):
+    product = 1
+    for i in args:
+        product *= i
+    return product
+
+def old_calc_div(*args):
+    if len(args) == 1:
+        return 1 / args[0]
+    first_num, *rest_nums = args
+    return first_num / OLD_ARITHMETIC['*'](*rest_nums)
+
+OLD_ARITHMETIC.update({
+    "+": lambda *args: sum(args),
+    "-": old_calc_sub,
+    "*": old_calc_mult,
+    "/": old_calc_div,
+})
+
+
+@benchmark
+def bench_arithmetic(calls=200_000, iterations=50_000):
+    print(f"arithmetic builtins: before vs after the numeric tower")
+    new = {name: lab.scheme_builtins[name] for name in OLD_ARITHMETIC}
+    for name in OLD_ARITHMETIC:
+        for args in [(7, 3), (7, 3, 2)]:
+            for kind, builtins in [("old", OLD_ARITHMETIC), ("new", new)]:
+                func = builtins[name]
+                def run():
+                    for _ in range(calls):
+                        func(*args)
+                seconds, _ = best_time(run)
+                report(f"({name} {' '.join(map(str, args))}) x{calls}, {kind}", seconds)
+
+    loop = lab.parse(lab.tokenize(
+        "(define (loop n acc) (if (equal? n 0) acc"
+        " (loop (- n 1) (+ (* acc 1.0001) (/ n 3) (- n 2)))))"
+    ))
+    expr = lab.parse(lab.tokenize(f"(loop {iterations} 0)"))
+    for kind, builtins in [("old", OLD_ARITHMETIC), ("new", new)]:
+        frame = lab.make_initial_frame()
+        frame.namespace.update(builtins)
+        lab.evaluate(loop, frame)
+        seconds, _ = best_time(lab.evaluate, expr, frame)
+        report(f"arithmetic loop ({iterations} iterations), {kind}", seconds)
+
+    frame = lab.make_initial_frame()
+    for name, source in [
+        ("(expt 3 100000)", "(expt 3 100000)"),
+        ("sum of 1/k, k = 1..500 (exact)", "(reduce + (map (lambda (k) (/ (exact 1) k)) (range 1 501)) 0)"),
+    ]:
+        seconds, _ = best_time(lab.evaluate, lab.parse(lab.tokenize(source)), frame)
+        report(name, seconds)
+
+
+def uncached_compile_symbol(name, scope=None):
+    """
+    compile_symbol as it was before lookups were cached: a top-level name
+    is searched for frame by frame on every evaluation.
+    """
+    steps = lab.resolve(name, scope)
+    hops, slot = steps[-1]
+    if len(steps) == 1 and slot is None:
+        def lookup_top(frame):
+            for _ in range(hops):
+                frame = frame.parent
+            while frame is not None:
+                namespace = frame.namespace
+                if name in namespace:
+                    return namespace[name]
+                frame = frame.parent
+            raise lab.SchemeNameError
+        return lookup_top
+    return cached_compile_symbol(name, scope)
+
+cached_compile_symbol = lab.compile_symbol
+
+
+@benchmark
+def bench_lookups(n=20, iterations=200_000):
+    print("top-level name lookups: searched every time vs cached")
+    sources = [
+        "(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))",
+        "(define (loop n acc) (if (equal? n 0) acc (loop (- n 1) (cons (car acc) (cdr acc)))))",
+    ]
+    for kind, compile_symbol in [("searched", uncached_compile_symbol), ("cached", cached_compile_symbol)]:
+        lab.compile_symbol = compile_symbol
+        try:
+            frame = lab.make_initial_frame()
+            for source in sources:
+                lab.evaluate(lab.parse(lab.tokenize(source)), frame)
+            for source in [f"(fib {n})", f"(loop {iterations} (list 1 2))"]:
+                seconds, _ = best_time(lab.evaluate, lab.parse(lab.tokenize(source)), frame)
+                report(f"{source}, {kind}", seconds)
+        finally:
+            lab.compile_symbol = cached_compile_symbol
+
+
+# most a Budget may slow evaluation down by
+BUDGET_OVERHEAD_LIMIT = 0.05
+
+
+@benchmark
+def bench_budget(n=17, length=10_000, rounds=100):
+    print(f"Budget overhead ((fib {n}), building a {length}-element list), "
+          f"limit {BUDGET_OVERHEAD_LIMIT:.0%}")
+    frame = lab.make_initial_frame()
+    for line in [
+        "(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))",
+        "(define (build n acc) (if (equal? n 0) acc (build (- n 1) (cons n acc))))",
+    ]:
+        lab.evaluate(lab.parse(lab.tokenize(line)), frame)
+    budgets = {
+        "no budget": lambda: None,
+        "steps + pairs + timeout": lambda: lab.Budget(max_steps=10**9, max_pairs=10**9, timeout=600),
+    }
+    for source in [f"(fib {n})", f"(length (build {length} (list)))", f"(length (range {length}))"]:
+        expr = lab.parse(lab.tokenize(source))
+        # many short runs, alternating, so a slow spell on the machine hits
+        # both alike and the best of each is near its true time
+        best = dict.fromkeys(budgets, float("inf"))
+        for _ in range(rounds):
+            for name, make_budget in budgets.items():
+                budget = make_budget()
+                seconds, _ = best_time(lambda: lab.evaluate(expr, frame, budget), repeat=1)
+                best[name] = min(best[name], seconds)
+        for name, seconds in best.items():
+            report(f"{source}, {name}", seconds)
+        overhead = best["steps + pairs + timeout"] / best["no budget"] - 1
+        verdict = "ok" if overhead < BUDGET_OVERHEAD_LIMIT else "OVER THE LIMIT"
+        print(f"  {'':<40} {overhead:+10.1%}     overhead, {verdict}")
+
+
+@benchmark
+def bench_frames(n=20, iterations=200_000):
+    print("frame pooling: SlotFrames allocated and peak memory, pools off vs on")
+    frame = lab.make_initial_frame()
+    for line in [
+        "(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))",
+        "(define (loop n acc) (if (equal? n 0) acc (let ((m (- n 1))) (loop m (+ acc 1)))))",
+        "(define (adders n acc) (if (equal? n 0) acc (adders (- n 1) ((lambda (x) (+ x n)) acc))))",
+    ]:
+        lab.evaluate(lab.parse(lab.tokenize(line)), frame)
+
+    created = [0]
+    slot_frame_init = lab.SlotFrame.__init__
+    def counting_init(self, parent, slots):
+        created[0] += 1
+        slot_frame_init(self, parent, slots)
+
+    pool_size = lab.FRAME_POOL_SIZE
+    lab.SlotFrame.__init__ = counting_init
+    try:
+        for source in [f"(fib {n})", f"(loop {iterations} 0)", f"(adders {iterations // 4} 0)"]:
+            expr = lab.parse(lab.tokenize(source))
+            for kind, size in [("off", 0), ("on", pool_size)]:
+                lab.FRAME_POOL_SIZE = size
+                created[0] = 0
+                lab.evaluate(expr, frame)
+                count = created[0]
+                peak = peak_memory(lab.evaluate, expr, frame) / 1024
+                seconds, _ = best_time(lab.evaluate, expr, frame)
+                report(f"{source}, pools {kind}", seconds, f"{count:>9} SlotFrames, peak {peak:.0f} KiB")
+    finally:
+        lab.SlotFrame.__init__ = slot_frame_init
+        lab.FRAME_POOL_SIZE = pool_size
+
+
+#############################
+# Lists #
+#############################
+
+@benchmark
+def bench_lists(n=100_000):
+    print(f"lists ({n} elements)")
+    frame = lab.make_initial_frame()
+    for line in [
+        "(define (build n acc) (if (equal? n 0) acc (build (- n 1) (cons n acc))))",
+        f"(define big (build {n} (list)))",
+    ]:
+        lab.evaluate(lab.parse(lab.tokenize(line)), frame)
+
+    elems = list(range(n))
+    seconds, _ = best_time(lab.create_list, *elems)
+    per_pair = peak_memory(lab.create_list, *elems) / n
+    report("list", seconds, f"{per_pair:.0f} bytes/pair")
+
+    for name, source in [
+        ("cons loop", f"(build {n} (list))"),
+        ("append", "(append big big)"),
+        ("length", "(length big)"),
+        ("list?", "(list? big)"),
+        ("list-ref (last element)", f"(list-ref big {n - 1})"),
+    ]:
+        seconds, _ = best_time(lab.evaluate, lab.parse(lab.tokenize(source)), frame)
+        report(name, seconds)
+
+
+@benchmark
+def bench_vectors():
+    print("sudoku: lists (sudoku.scm) vs vectors (sudoku_vectors.scm)")
+    frames = {}
+    for fname in ("sudoku.scm", "sudoku_vectors.scm"):
+        frames[fname] = lab.make_initial_frame()
+        lab.evaluate_file(os.path.join(FILES_DIRECTORY, "map_filter_reduce.scm"), frames[fname])
+        lab.evaluate_file(os.path.join(FILES_DIRECTORY, fname), frames[fname])
+    for board in ("board1", "board4"):
+        expr = lab.parse(lab.tokenize(f"(solve-sudoku {board})"))
+        results = []
+        for fname, frame in frames.items():
+            seconds, result = best_time(lab.evaluate, expr, frame, repeat=1)
+            results.append(result)
+            report(f"{board}, {fname}", seconds)
+        assert results[0] == results[1], "solvers disagree"
+
+
+# Collatz chain lengths for 1..n, with the lengths already found kept in a
+# table: either an association list searched with assoc-ref or a hash table.
+COLLATZ = """
+(define (next n) (if (equal? (modulo n 2) 0) (car (floor/ n 2)) (+ (* 3 n) 1)))
+(define (total i n acc) (if (> i n) acc (total (+ i 1) n (+ acc (steps i)))))
+"""
+ALIST_MEMO = COLLATZ + """
+(define table (list))
+(define (assoc-ref key alist)
+  (if (equal? alist (list)) #f
+      (if (equal? (car (car alist)) key) (car alist) (assoc-ref key (cdr alist)))))
+(define (steps n)
+  (if (equal? n 1) 0
+      (begin
+        (define hit (assoc-ref n table))
+        (if hit (cdr hit)
+            (begin
+              (define s (+ 1 (steps (next n))))
+              (set! table (cons (cons n s) table))
+              s)))))
+"""
+HASH_MEMO = COLLATZ + """
+(define table (make-hash))
+(define (steps n)
+  (if (equal? n 1) 0
+      (if (hash-has-key? table n) (hash-ref table n)
+          (begin
+            (define s (+ 1 (steps (next n))))
+            (hash-set! table n s)
+            s))))
+"""
+
+
+@benchmark
+def bench_hash_tables():
+    print("memo table for Collatz chain lengths: association list vs hash table")
+    for n in (30, 100, 300):
+        results = []
+        for kind, source in [("alist", ALIST_MEMO), ("hash", HASH_MEMO)]:
+            def run():
+                frame = lab.make_initial_frame()
+                lab.evaluate(lab.parse(lab.tokenize(f"(begin {source})")), frame)
+                return lab.evaluate(lab.parse(lab.tokenize(f"(total 1 {n} 0)")), frame)
+            seconds, result = best_time(run)
+            results.append((seconds, result))
+            report(f"n = {n}, {kind}", seconds)
+        assert results[0][1] == results[1][1], "memo tables disagree"
+        print(f"  {'':<40} {results[0][0] / results[1][0]:10.1f}x faster with a hash table")
+
+
+def run_sessions(sessions, load_mfr):
+    for n in sessions:
+        frame = lab.make_initial_frame()
+        if load_mfr:
+            lab.evaluate_file(os.path.join(FILES_DIRECTORY, "map_filter_reduce.scm"), frame)
+        with open(os.path.join(TEST_DIRECTORY, "test_inputs", f"{n:02d}.scm")) as f:
+            for line in f:
+                try:
+                    lab.evaluate(lab.parse(lab.tokenize(line)), frame)
+                except lab.SchemeError:
+                    pass
+
+
+@benchmark
+def bench_map_filter_reduce(n=2_000):
+    print("map/filter/reduce: Scheme definitions vs native builtins")
+    pipeline = lab.parse(lab.tokenize(
+        "(reduce + (map (lambda (i) (* i i)) (filter (lambda (i) (< i 0)) big)) 0)"
+    ))
+    for load_mfr, kind in [(True, "Scheme"), (False, "native")]:
+        seconds, _ = best_time(run_sessions, range(78, 85), load_mfr)
+        report(f"test sessions 78-84, {kind}", seconds)
+        frame = lab.make_initial_frame()
+        if load_mfr:
+            lab.evaluate_file(os.path.join(FILES_DIRECTORY, "map_filter_reduce.scm"), frame)
+        lab.evaluate(lab.parse(lab.tokenize(f"(define big (range {-n // 2} {n // 2}))")), frame)
+        seconds, _ = best_time(lab.evaluate, pipeline, frame)
+        report(f"pipeline, {n} elements, {kind}", seconds)
+
+
+@benchmark
+def bench_profiler(n=18):
+    print(f"profiler overhead ((fib {n}))")
+    frame = lab.make_initial_frame()
+    lab.evaluate(lab.parse(lab.tokenize(
+        "(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))"
+    )), frame)
+    expr = lab.parse(lab.tokenize(f"(fib {n})"))
+    seconds, _ = best_time(lab.evaluate, expr, frame)
+    report("not profiling", seconds)
+    lab.start_profiling()
+    try:
+        seconds, _ = best_time(lab.evaluate, expr, frame)
+    finally:
+        profiler = lab.stop_profiling()
+    calls = sum(calls for calls, _, _ in profiler.stats.values())
+    report("profiling", seconds, f"{calls} calls recorded")
+    seconds, _ = best_time(lab.evaluate, expr, frame)
+    report("after stop_profiling", seconds)
+
+
+@benchmark
+def bench_memo():
+    print("(fib n): define vs define-memo")
+    fib = "({} (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))"
+    for form, sizes in [("define", (10, 15, 20, 22)), ("define-memo", (10, 15, 20, 22, 500, 1000))]:
+        for n in sizes:
+            # a fresh definition each time, so the memo cache starts empty
+            def run():
+                frame = lab.make_initial_frame()
+                lab.evaluate(lab.parse(lab.tokenize(fib.format(form))), frame)
+                return lab.evaluate(lab.parse(lab.tokenize(f"(fib {n})")), frame)
+            seconds, _ = best_time(run)
+            report(f"{form}, n = {n}", seconds)
+
+
+@benchmark
+def bench_pmap(n=18, count=16):
+    print(f"map vs pmap: (fib {n}) for {count} elements, {lab.PMAP_WORKERS} workers")
+    frame = lab.make_initial_frame()
+    lab.evaluate(lab.parse(lab.tokenize(
+        "(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))"
+    )), frame)
+    lab.pmap_pool()  # start the workers outside the timing
+    for name in ("map", "pmap"):
+        expr = lab.parse(lab.tokenize(f"({name} fib (list {' '.join([str(n)] * count)}))"))
+        seconds, _ = best_time(lab.evaluate, expr, frame, repeat=1)
+        report(name, seconds)
+    expr = lab.parse(lab.tokenize("(pmap (lambda (x) (* x x)) (range 100000))"))
+    seconds, _ = best_time(lab.evaluate, expr, frame, repeat=1)
+    report("pmap of a cheap function, 100000 elements", seconds)
+
+
+#############################
+# Startup #
+#############################
+
+@benchmark
+def bench_startup(copies=200):
+    print(f"startup (sudoku.scm definitions x{copies}): cold vs warm parse cache")
+    directory = tempfile.mkdtemp()
+    try:
+        script = os.path.join(directory, "big.scm")
+        with open(script, "w") as f:
+            f.write("\n".join([read_test_file("sudoku.scm")] * copies))
+        cache = os.path.join(directory, lab.CACHE_DIRECTORY)
+
+        def cold():
+            shutil.rmtree(cache, ignore_errors=True)
+            return lab.evaluate_file(script, use_cache=True)
+
+        def warm():
+            return lab.evaluate_file(script, use_cache=True)
+
+        def command_line():
+            subprocess.run(
+                [sys.executable, os.path.join(TEST_DIRECTORY, "lab.py"), script],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True,
+            )
+
+        seconds, _ = best_time(lab.evaluate_file, script)
+        report("evaluate_file, no cache", seconds)
+        seconds, _ = best_time(cold)
+        report("evaluate_file, cold cache", seconds)
+        seconds, _ = best_time(warm)
+        report("evaluate_file, warm cache", seconds)
+        shutil.rmtree(cache, ignore_errors=True)
+        seconds, _ = best_time(command_line, repeat=1)
+        report("python lab.py, cold cache", seconds)
+        seconds, _ = best_time(command_line)
+        report("python lab.py, warm cache", seconds)
+    finally:
+        shutil.rmtree(directory)
+
+
+@benchmark
+def bench_images(copies=20, table_size=2_000):
+    print(f"startup: running a prelude vs loading its image (test_files x{copies})")
+    directory = tempfile.mkdtemp()
+    try:
+        prelude = os.path.join(directory, "prelude.scm")
+        with open(prelude, "w") as f:
+            for fname in ["map_filter_reduce.scm", "sudoku.scm", "sudoku_vectors.scm", "ndmines.scm"] * copies:
+                f.write(read_test_file(fname) + "\n")
+            # and some data the prelude has to compute, not just define
+            f.write(f"(define squares (map (lambda (i) (* i i)) (range 0 {table_size})))\n")
+            f.write(f"(define evens (filter (lambda (i) (equal? (modulo i 2) 0)) squares))\n")
+            f.write("(define lookup (make-hash))\n")
+            f.write(f"(map (lambda (i) (hash-set! lookup i (list i (* i i)))) (range 0 {table_size}))\n")
+        image = os.path.join(directory, "prelude.img")
+
+        def run_prelude(use_cache):
+            frame = lab.make_initial_frame()
+            lab.evaluate_file(prelude, frame, use_cache=use_cache)
+            return frame
+
+        lab.save_image(run_prelude(True), image)
+        print(f"  prelude {os.path.getsize(prelude) / 1024:,.0f} KiB of source, "
+              f"image {os.path.getsize(image) / 1024:,.0f} KiB")
+        seconds, _ = best_time(run_prelude, False)
+        report("evaluate_file, no cache", seconds)
+        seconds, _ = best_time(run_prelude, True)
+        report("evaluate_file, warm parse cache", seconds)
+        seconds, _ = best_time(lab.save_image, run_prelude(True), image)
+        report("save_image", seconds)
+        seconds, _ = best_time(lab.load_image, image)
+        report("load_image", seconds)
+
+        def fresh_process(code):
+            subprocess.run([sys.executable, "-c", code], cwd=TEST_DIRECTORY, check=True)
+
+        for name, code in [
+            ("new process, evaluate_file (warm cache)",
+             f"import lab; lab.evaluate_file({prelude!r}, lab.make_initial_frame(), use_cache=True)"),
+            ("new process, load_image", f"import lab; lab.load_image({image!r})"),
+            ("new process, import lab only", "import lab"),
+        ]:
+            seconds, _ = best_time(fresh_process, code)
+            report(name, seconds)
+    finally:
+        shutil.rmtree(directory)
+
+
+@benchmark
+def bench_repl_paste(copies=50):
+    import io
+    import schemerepl
+    source = "\n".join([read_test_file("sudoku.scm")] * copies)
+    lines = source.splitlines()
+    print(f"pasting sudoku.scm x{copies} into the REPL ({len(lines)} lines)")
+
+    def paste():
+        repl = schemerepl.SchemeREPL(lab, use_frames=True)
+        stdout, sys.stdout = sys.stdout, io.StringIO()
+        try:
+            for line in lines:
+                repl.onecmd(line)
+        finally:
+            sys.stdout = stdout
+
+    def evaluate_stream():
+        lab.evaluate_stream(io.StringIO(source), lab.make_initial_frame())
+
+    seconds, _ = best_time(evaluate_stream)
+    report("evaluate_stream", seconds)
+    seconds, _ = best_time(paste)
+    report("SchemeREPL.onecmd, line by line", seconds)
+
+
+#############################
+# Batch runner #
+#############################
+
+@benchmark
+def bench_batch(copies=8):
+    import batch
+    filenames = [
+        os.path.join(FILES_DIRECTORY, fname)
+        for fname in sorted(os.listdir(FILES_DIRECTORY)) if fname.endswith(".scm")
+    ] * copies
+    print(f"batch runner ({len(filenames)} files, {os.cpu_count()} CPUs)")
+    seconds, _ = best_time(lambda: [batch.run_file(fname) for fname in filenames])
+    report("in this process, one after another", seconds)
+    for workers in sorted({1, 2, os.cpu_count()}):
+        seconds, results = best_time(lambda: list(batch.run_batch(filenames, workers)))
+        peak = max(result.max_rss for result in results) / 2**20
+        report(f"run_batch, {workers} workers", seconds, f"worker peak RSS {peak:.1f} MiB")
+
+
+
+#############################
+# Interpreters #
+#############################
+
+SESSION = """
+(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+(set! + *)
+(define squares (map (lambda (x) (* x x)) (list 1 2 3 4 5 6 7 8)))
+(reduce + (filter (lambda (x) (> x 10)) squares) (fib 10))
+"""
+
+
+@benchmark
+def bench_interpreters(sessions=2_000, count=100_000):
+    from concurrent.futures import ThreadPoolExecutor
+    print(f"Interpreter sessions ({sessions} sessions over a map_filter_reduce.scm prelude)")
+    mfr = os.path.join(FILES_DIRECTORY, "map_filter_reduce.scm")
+    base = lab.make_base(mfr)
+    seconds, _ = best_time(lambda: [lab.Interpreter(base) for _ in range(count)])
+    report(f"create {count} Interpreters", seconds, f"{count / seconds:12,.0f} /s")
+
+    def fresh_frame(_):
+        frame = lab.make_initial_frame()
+        lab.evaluate_file(mfr, frame, use_cache=True)
+        for expr in lab.parse_stream(lab.tokenize(SESSION)):
+            lab.evaluate(expr, frame)
+
+    def interpreter(_):
+        return lab.Interpreter(base).run(SESSION)
+
+    seconds, _ = best_time(lambda: [fresh_frame(i) for i in range(sessions)])
+    report("make_initial_frame + prelude, one thread", seconds, f"{sessions / seconds:12,.0f} sessions/s")
+    seconds, _ = best_time(lambda: [interpreter(i) for i in range(sessions)])
+    report("Interpreter, one thread", seconds, f"{sessions / seconds:12,.0f} sessions/s")
+    for workers in (1, 2, 4, 8):
+        with ThreadPoolExecutor(workers) as executor:
+            seconds, _ = best_time(lambda: list(executor.map(interpreter, range(sessions))))
+        report(f"Interpreter, ThreadPoolExecutor({workers})", seconds, f"{sessions / seconds:12,.0f} sessions/s")
+
+
+#############################
+# Regression suite #
+#############################
+
+LISP_1_FILE = os.path.join(TEST_DIRECTORY, "..", "lisp_1", "lab.py")
+# the latest run, which git ignores; pass --output to keep one somewhere else
+RESULTS_FILE = os.path.join(TEST_DIRECTORY, "bench_results.json")
+BASELINE_FILE = os.path.join(TEST_DIRECTORY, "bench_baseline.json")
+
+# a nearly solved board, so one solve takes milliseconds rather than seconds
+SUDOKU_PUZZLE = """(define puzzle (list
+  (list 5 1 7 6 0 8 2 3 4) (list 2 8 9 0 3 4 7 5 6) (list 3 4 6 2 7 5 8 9 1)
+  (list 6 7 2 8 4 9 3 1 5) (list 1 3 8 5 2 6 9 4 7) (list 9 5 4 7 1 3 6 0 2)
+  (list 4 9 5 3 6 2 1 7 8) (list 7 2 3 4 8 1 5 6 9) (list 8 0 1 9 5 7 4 2 0)))
+(solve-sudoku puzzle)"""
+
+# name -> (files from test_files to load first, source to run after them)
+SUITE = {
+    "arithmetic": ((), """
+        (define (square x) (* x x))
+        (define (compose f g) (lambda (x) (f (g x))))
+        (define quad (compose square square))
+        (define (add3 a b c) (+ a b c))
+    """ + "(add3 (quad 3) (square 4) (- 10 (/ 8 2)))\n" * 200),
+    "fib": ((), """
+        (define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+        (fib 15)
+    """),
+    "tak": ((), """
+        (define (tak x y z)
+          (if (not (< y x)) z (tak (tak (- x 1) y z) (tak (- y 1) z x) (tak (- z 1) x y))))
+        (tak 12 8 4)
+    """),
+    "list building": ((), """
+        (define (build n acc) (if (equal? n 0) acc (build (- n 1) (cons n acc))))
+        (length (build 2000 (list)))
+    """),
+    "sudoku.scm": (("map_filter_reduce.scm", "sudoku.scm"), SUDOKU_PUZZLE),
+    "ndmines.scm": (("map_filter_reduce.scm", "ndmines.scm"), """
+        (define game (new-game-nd (list 6 6) (list (list 0 0) (list 5 5) (list 2 3))))
+        (dig-nd game (list 0 5))
+        (game-get-state game)
+    """),
+    "map_filter_reduce.scm": (("map_filter_reduce.scm",), f"""
+        (define numbers (list {" ".join(str(i) for i in range(-100, 100))}))
+        (reduce + (map (lambda (x) (* x x)) (filter (lambda (x) (> x 0)) numbers)) 0)
+    """),
+}
+
+
+def load_lisp_1():
+    import importlib.util
+    spec = importlib.util.spec_from_file_location("lisp_1_lab", LISP_1_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def split_expressions(tokens):
+    """
+    Split a token list into one token list per top-level expression, since
+    neither interpreter's parse accepts more than one.
+    """
+    expressions, start, depth = [], 0, 0
+    for i, token in enumerate(tokens):
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        if depth == 0:
+            expressions.append(tokens[start:i + 1])
+            start = i + 1
+    return expressions
+
+
+def run_program(module, source):
+    """
+    Parse and evaluate source in a fresh frame; return (parse seconds,
+    evaluate seconds, value of the last expression).
+    """
+    start = time.perf_counter()
+    trees = [module.parse(tokens) for tokens in split_expressions(module.tokenize(source))]
+    parsed = time.perf_counter()
+    frame = module.make_initial_frame()
+    for tree in trees:
+        value = module.evaluate(tree, frame)
+    return parsed - start, time.perf_counter() - parsed, value
+
+
+def measure(module, source, min_time=0.5):
+    """
+    Run source over and over for at least min_time seconds.  Programs the
+    interpreter can't run (lisp_1 has no if, lists or begin) are reported
+    by the name of the error they raise instead.
+    """
+    try:
+        run_program(module, source)
+    except (module.SchemeError, RecursionError) as e:
+        return {"error": type(e).__name__}
+    runs, parse, evaluate = 0, 0.0, 0.0
+    start = time.perf_counter()
+    while runs < 3 or time.perf_counter() - start < min_time:
+        parse_seconds, eval_seconds, _ = run_program(module, source)
+        parse += parse_seconds
+        evaluate += eval_seconds
+        runs += 1
+    return {
+        "ops_per_sec": runs / (parse + evaluate),
+        "parse_seconds": parse / runs,
+        "eval_seconds": evaluate / runs,
+        "peak_bytes": peak_memory(run_program, module, source),
+    }
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Messages for every program that got slower or hungrier than baseline by
+    more than tolerance (a fraction), or that no longer runs at all.
+    """
+    found = []
+    for key, old in baseline.items():
+        new = results.get(key)
+        if new is None or "error" in old:
+            continue
+        if "error" in new:
+            found.append(f"{key}: now raises {new['error']}")
+            continue
+        if new["ops_per_sec"] < old["ops_per_sec"] * (1 - tolerance):
+            found.append(f"{key}: {new['ops_per_sec']:,.1f} ops/s, "
+                         f"was {old['ops_per_sec']:,.1f}")
+        if new["peak_bytes"] > old["peak_bytes"] * (1 + tolerance):
+            found.append(f"{key}: peak {new['peak_bytes'] / 1024:,.0f} KiB, "
+                         f"was {old['peak_bytes'] / 1024:,.0f}")
+    return found
+
+
+@benchmark
+def bench_suite(output=RESULTS_FILE, baseline=BASELINE_FILE, save_baseline=False, tolerance=0.2):
+    import json
+    import platform
+    print("regression suite: lisp_1 vs lisp_2")
+    interpreters = {"lisp_1": load_lisp_1(), "lisp_2": lab}
+    results = {}
+    for name, (files, source) in SUITE.items():
+        source = "\n".join([read_test_file(fname) for fname in files] + [source])
+        for interpreter, module in interpreters.items():
+            key = f"{interpreter}/{name}"
+            results[key] = result = measure(module, source)
+            if "error" in result:
+                print(f"  {key:<40} {'':>13}  unsupported ({result['error']})")
+                continue
+            total = result["parse_seconds"] + result["eval_seconds"]
+            report(key, total, f"{result['ops_per_sec']:10,.1f} ops/s  "
+                   f"parse {result['parse_seconds'] / total:4.0%}  "
+                   f"peak {result['peak_bytes'] / 1024:8,.0f} KiB")
+
+    document = {"python": platform.python_version(), "time": time.time(), "results": results}
+    for path in [output] + ([baseline] if save_baseline else []):
+        with open(path, "w") as f:
+            json.dump(document, f, indent=2)
+        print(f"  wrote {path}")
+
+    if save_baseline or not os.path.exists(baseline):
+        return []
+    with open(baseline) as f:
+        found = regressions(results, json.load(f)["results"], tolerance)
+    for message in found:
+        print(f"  REGRESSION {message}")
+    if not found:
+        print(f"  no regressions against {baseline} (tolerance {tolerance:.0%})")
+    return found
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the interpreter.")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run (default: all of {sorted(BENCHMARKS)})")
+    parser.add_argument("--output", default=RESULTS_FILE, help="where suite writes its JSON results")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="suite results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store suite results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown or memory growth (fraction) counted as a regression")
+    args = parser.parse_args()
+
+    found = []
+    for name in args.names or list(BENCHMARKS):
+        if name not in BENCHMARKS:
+            sys.exit(f"unknown benchmark {name!r}; choose from {sorted(BENCHMARKS)}")
+        if name == "suite":
+            found = bench_suite(args.output, args.baseline, args.save_baseline, args.tolerance)
+        else:
+            BENCHMARKS[name]()
+    sys.exit(1 if found else 0)
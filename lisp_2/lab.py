@@ -4,7 +4,25 @@ LISP Interpreter Part 2
 """
 
 #!/usr/bin/env python3
+import os
+import io
+import re
+import math
+import operator
 import sys
+import time
+import pickle
+import tempfile
+import collections
+import hashlib
+import heapq
+import functools
+import itertools
+import threading
+import contextvars
+from fractions import Fraction
+# tail calls run in constant stack space (see TailCall), but non-tail
+# recursion such as (cons x (range ...)) still nests Python frames
 sys.setrecursionlimit(20_000)
 
 
@@ -25,10 +43,36 @@ class SchemeNameError(SchemeError):
 class SchemeEvaluationError(SchemeError):
     pass
 
+class SchemeBudgetError(SchemeError):
+    """
+    An evaluation ran past one of the limits of its Budget.
+    """
+    pass
+
 ############################
 # Tokenization and Parsing #
 ############################
 
+class Symbol(str):
+    """
+    A symbol in a parse tree.  Symbols are interned (see symbol), so each
+    name is stored once however many times it appears, and comparing two
+    of them only compares identities.  They are still strs, so they equal
+    (and hash like) the plain strings they spell.
+    """
+    __slots__ = ()
+    table = {}
+
+    def __reduce__(self):
+        # interned again when unpickled
+        return symbol, (str(self),)
+
+def symbol(name):
+    sym = Symbol.table.get(name)
+    if sym is None:
+        sym = Symbol.table[name] = Symbol(name)
+    return sym
+
 def number_or_symbol(value):
     try:
         return int(value)
@@ -36,28 +80,67 @@ def number_or_symbol(value):
         try:
             return float(value)
         except ValueError:
-            return value
+            pass
+    if "/" in value:
+        try:
+            return Fraction(value)  # an exact rational like 1/3
+        except (ValueError, ZeroDivisionError):  # 1/0 is just a name
+            pass
+    return symbol(value)
+
+TOKEN_PATTERN = re.compile(r"[()]|;[^\n]*|[^() \n;]+")
+
+class Tokenizer:
+    """
+    Incremental tokenizer.  Text can be fed in arbitrary pieces; a token or
+    comment cut off at the end of one piece is carried over to the next.
+    """
+    def __init__(self):
+        self.pending = ""
+        self.comment = False
+
+    def feed(self, text):
+        if self.comment:
+            newline = text.find("\n")
+            if newline == -1:
+                return []
+            self.comment = False
+            text = text[newline:]
+        text = self.pending + text
+        self.pending = ""
+
+        tokens = []
+        for match in TOKEN_PATTERN.finditer(text):
+            token = match.group()
+            if match.end() == len(text) and token != "(" and token != ")":
+                if token[0] == ";":
+                    self.comment = True
+                else:
+                    self.pending = token
+                break
+            if token[0] != ";":
+                tokens.append(token)
+        return tokens
+
+    def close(self):
+        tokens = [self.pending] if self.pending else []
+        self.pending = ""
+        self.comment = False
+        return tokens
 
 def tokenize(source):
-    source += " "
-    tokens = []
-    comment = False
-    non_real_tokens = {"(", ")", " ", "\n", ";"}
-    real_token = ""
-
-    for char in source:
-        if not comment and char not in non_real_tokens:
-            real_token += char
-        else:
-            if real_token: tokens.append(real_token)
-            real_token = "" 
-
-            if char == " ": continue
-            elif char in {"(", ")"} and not comment: 
-                tokens.append(char)
-            elif char == ";": comment = True
-            elif char == "\n": comment = False
-    return tokens
+    tokenizer = Tokenizer()
+    return tokenizer.feed(source) + tokenizer.close()
+
+def tokenize_stream(stream, chunk_size=1 << 16):
+    """
+    Lazily yield tokens from a text stream (file, pipe, sys.stdin, ...),
+    reading it chunk_size characters at a time.
+    """
+    tokenizer = Tokenizer()
+    while chunk := stream.read(chunk_size):
+        yield from tokenizer.feed(chunk)
+    yield from tokenizer.close()
 
 keywords = {
     "define",
@@ -65,75 +148,248 @@ keywords = {
     "if",
 }
 
+class Parser:
+    """
+    Incremental parser.  Tokens can be fed in any number of batches, and
+    each top-level expression is produced as soon as its last token is seen.
+    """
+    def __init__(self):
+        self.stack = []
+        self.prev = None
+        self.atoms = {}
+
+    @property
+    def depth(self):
+        return len(self.stack)
+
+    def feed(self, tokens):
+        stack = self.stack
+        atoms = self.atoms
+        for token in tokens:
+            if token == "(":
+                stack.append([])
+                self.prev = token
+                continue
+            if token == ")":
+                if not stack: raise SchemeSyntaxError
+                expr = stack.pop()
+            else:
+                if token in keywords and self.prev != "(":
+                    raise SchemeSyntaxError
+                if token not in atoms:
+                    atoms[token] = number_or_symbol(token)
+                expr = atoms[token]
+            self.prev = token
+
+            if stack:
+                stack[-1].append(expr)
+            else:
+                yield expr
+
 def parse(tokens):
-    def parse_rec(start, end):
-        lpar = 0
-        rpar = 0
-        for i in range(start, end+1):
-            token = tokens[i]
-            if token == "(": lpar += 1
-            elif token == ")": rpar += 1
-            if rpar > lpar: raise SchemeSyntaxError
-            if token in keywords and \
-                (not start == end) and \
-                ((i == start) or (tokens[i-1] != "(")):
-                raise SchemeSyntaxError
-        if lpar != rpar: raise SchemeSyntaxError
-
-        if start == end:
-            return number_or_symbol(tokens[start])
-
-        parsed_tokens = []
-        token_index = start+1
-        
-        while token_index < end:
-            new_start = token_index
-            if tokens[token_index] == "(":
-                num_lpar = 0
-                num_rpar = 0
-                while token_index < end:
-                    if tokens[token_index] == "(":
-                        num_lpar += 1
-                    elif tokens[token_index] == ")":
-                        num_rpar += 1
-                        if num_rpar == num_lpar:
-                            break
-                    token_index += 1
-            new_end = token_index
-            parsed_tokens.append(parse_rec(new_start, new_end))
-            token_index += 1
-        return parsed_tokens
-
-    return parse_rec(0, len(tokens)-1)
+    if not tokens:
+        return []
+    if len(tokens) == 1 and tokens[0] not in {"(", ")"}:
+        return number_or_symbol(tokens[0])
+
+    parser = Parser()
+    expressions = list(parser.feed(tokens))
+    if parser.depth or len(expressions) != 1: raise SchemeSyntaxError
+    return expressions[0]
+
+def compact(tree, nodes=None):
+    """
+    tree as tuples instead of lists, with symbols interned and identical
+    subtrees shared: the nodes table maps the contents of every tuple built
+    so far to that tuple, so pass the same table to share subtrees between
+    trees.  Programs are mostly repeats of the same few small forms, so
+    this makes a long-lived tree (like a Function body or a cache entry)
+    much smaller.
+    """
+    if nodes is None:
+        nodes = {}
+
+    def share(tree):
+        if not isinstance(tree, (list, tuple)):
+            return symbol(tree) if isinstance(tree, str) else tree
+        children = tuple([share(sub) for sub in tree])
+        key = tuple([node_key(child) for child in children])
+        return nodes.setdefault(key, children)
+    return share(tree)
+
+def node_key(child):
+    # children are already shared, so tuples compare by identity here;
+    # floats go by repr, since -0.0 == 0.0 but they aren't the same literal
+    if type(child) is tuple:
+        return id(child)
+    if type(child) is float:
+        return (float, repr(child))
+    return (type(child), child)
+
+def parse_stream(tokens):
+    """
+    Lazily yield each top-level expression from an iterable of tokens.
+    """
+    parser = Parser()
+    yield from parser.feed(tokens)
+    if parser.depth: raise SchemeSyntaxError
 
 
 ######################
 # Built-in Functions #
 ######################
 
+# Numbers are Python ints (which are already bignums), Fractions (exact
+# rationals, written like 1/3) and floats, and mix the way Python mixes
+# them.  Dividing two ints still gives a float unless the result is too big
+# for one; use exact to turn a number into a Fraction.  Most calls have two
+# arguments, so each operator checks for that first.
+
+def calc_add(*args):
+    if len(args) == 2:
+        return args[0] + args[1]
+    return sum(args)
+
 def calc_sub(*args):
+    if len(args) == 2:
+        return args[0] - args[1]
     if len(args) == 1:
         return -args[0]
-    first_num, *rest_nums = args
-    return first_num - scheme_builtins['+'](*rest_nums)
+    if not args:
+        raise SchemeEvaluationError
+    return args[0] - sum(args[1:])
+
+def exact_bits(num):
+    """
+    About how many bits the numerator or denominator of an exact number
+    (whichever is bigger) takes up; 0 for anything else.
+    """
+    if not isinstance(num, (int, Fraction)):
+        return 0
+    numerator = abs(num.numerator)
+    return max(math.log2(numerator) if numerator else 0, math.log2(num.denominator))
 
 def calc_mult(*args):
-    product = 1
-    for i in args:
-        product *= i
-    return product
+    if ACTIVE_BUDGETS:
+        budget_int_bits(sum(exact_bits(arg) for arg in args))
+    if len(args) == 2:
+        return args[0] * args[1]
+    return math.prod(args)
+
+def exactly(func, *nums):
+    """
+    func on nums as Fractions, for when some int among them is too big for
+    a float.  The result is a float (or list of them) again if any of nums
+    was a float, and an error if it doesn't fit in one.
+    """
+    try:
+        result = func(*[Fraction(num) for num in nums])
+        if any(isinstance(num, float) for num in nums):
+            if isinstance(result, tuple):
+                return tuple(float(elem) for elem in result)
+            return float(result)
+    except (OverflowError, ValueError):  # infinities and nans have no Fraction
+        raise SchemeEvaluationError
+    return result
 
 def calc_div(*args):
-    if len(args) == 1:
-        return 1 / args[0]
-    first_num, *rest_nums = args
-    return first_num / scheme_builtins['*'](*rest_nums)
+    if len(args) == 2:
+        first_num, divisor = args
+    elif len(args) == 1:
+        first_num, divisor = 1, args[0]
+    elif args:
+        first_num, divisor = args[0], math.prod(args[1:])
+    else:
+        raise SchemeEvaluationError
+    try:
+        return first_num / divisor
+    except ZeroDivisionError:
+        raise SchemeEvaluationError
+    except OverflowError:
+        return exactly(operator.truediv, first_num, divisor)
+
+def number_args(args, count):
+    if len(args) != count or not all(isNum(arg) for arg in args):
+        raise SchemeEvaluationError
+    return args
+
+def floor_div(*args):
+    """
+    (floor/ n d) is the list (q r) with n = q*d + r, q rounded down.
+    """
+    dividend, divisor = number_args(args, 2)
+    if divisor == 0:
+        raise SchemeEvaluationError
+    try:
+        return create_list(*divmod(dividend, divisor))
+    except OverflowError:
+        return create_list(*exactly(divmod, dividend, divisor))
+
+def modulo(*args):
+    dividend, divisor = number_args(args, 2)
+    if divisor == 0:
+        raise SchemeEvaluationError
+    return dividend % divisor
+
+def expt(*args):
+    base, power = number_args(args, 2)
+    if ACTIVE_BUDGETS and isinstance(power, int):
+        budget_int_bits(abs(power) * exact_bits(base))
+    try:
+        result = base ** power
+    except (ZeroDivisionError, OverflowError):
+        raise SchemeEvaluationError
+    if isinstance(result, complex):
+        raise SchemeEvaluationError
+    return result
+
+def calc_sqrt(*args):
+    """
+    Exact for perfect squares of ints and Fractions, otherwise a float.
+    """
+    (num,) = number_args(args, 1)
+    if num < 0:
+        raise SchemeEvaluationError
+    if isinstance(num, int):
+        root = math.isqrt(num)
+        if root * root == num:
+            return root
+    elif isinstance(num, Fraction):
+        top, bottom = math.isqrt(num.numerator), math.isqrt(num.denominator)
+        if top * top == num.numerator and bottom * bottom == num.denominator:
+            return Fraction(top, bottom)
+    try:
+        return math.sqrt(num)
+    except OverflowError:
+        return float(math.isqrt(int(num)))
+
+def exact(*args):
+    """
+    num as a Fraction, so that dividing it keeps an exact result.
+    """
+    (num,) = number_args(args, 1)
+    if isinstance(num, float) and not math.isfinite(num):
+        raise SchemeEvaluationError
+    return Fraction(num)
+
+def inexact(*args):
+    (num,) = number_args(args, 1)
+    try:
+        return float(num)
+    except OverflowError:
+        raise SchemeEvaluationError
 
 scheme_builtins = {
-    "+": lambda *args: sum(args),
+    "+": calc_add,
     "-": calc_sub,
     "*": calc_mult,
     "/": calc_div,
+    "floor/": floor_div,
+    "modulo": modulo,
+    "expt": expt,
+    "sqrt": calc_sqrt,
+    "exact": exact,
+    "inexact": inexact,
 }
 
 #############################
@@ -141,6 +397,12 @@ scheme_builtins = {
 #############################
     
 class Frame:
+    # a frozen frame's bindings never change (see freeze); set! of them goes
+    # to the overlay of the session doing it instead (see Interpreter)
+    frozen = False
+    copy_on_write = False
+    overlay = None
+
     def __init__(self, parent=None, namespace=None):
         self.parent = parent
         self.namespace = namespace
@@ -150,49 +412,207 @@ class Frame:
     def __str__(self):
         return f'namespace: {str([x for x in self.namespace])}'
 
+class SlotFrame:
+    """
+    A frame whose names are fixed when its body is compiled, so variables
+    are stored in a list and looked up by position (see resolve).
+    """
+    __slots__ = ("parent", "slots")
+
+    def __init__(self, parent, slots):
+        self.parent = parent
+        self.slots = slots
+
 def make_initial_frame():   
     return Frame(GLOBAL_FRAME)
 
+# Every name has a version stamp, bumped whenever a binding of that name is
+# created, changed or deleted in any Frame, so a compiled lookup can keep
+# the value it found until the stamp moves (see compile_symbol).
+VERSIONS = {}
+
+def version_stamp(name):
+    stamp = VERSIONS.get(name)
+    if stamp is None:
+        # setdefault, so threads racing here still share one stamp
+        stamp = VERSIONS.setdefault(name, [0])
+    return stamp
+
+# The session frame (an Interpreter's copy_on_write frame) whose code is
+# running, for code that doesn't run in that frame itself: functions defined
+# in a shared prelude, which read and set! the prelude's globals.
+SESSION = contextvars.ContextVar("session", default=None)
+
+# names that some session has set! in a frozen frame, so lookups that reach
+# a frozen frame's binding of them have to check the session's overlay
+OVERLAID = set()
+
+def overlaid_value(name, frame, value, holder):
+    """
+    What the running session sees as the value of name, which the frozen
+    frame binds to value.  holder is the first frame with an overlay on the
+    way up to frame, if any.
+    """
+    if holder is None or not holder.copy_on_write:
+        # shared prelude code, so the session is whoever is running it,
+        # falling back to the prelude's own overlay
+        holder = SESSION.get() or holder
+        if holder is None:
+            return value
+    bindings = holder.overlay.get(frame)
+    return value if bindings is None else bindings.get(name, value)
+
 def create_variable(variable, value, frame):
+    if frame.frozen:
+        raise SchemeEvaluationError
     frame.namespace[variable] = value
+    version_stamp(variable)[0] += 1
     return value
 
-def get(variable, frame):
-    if isNum(variable):
-        return variable
-    if isExpression(variable) and variable[0] != 'lambda':
-        raise SchemeEvaluationError
-    while frame:
-        if variable in frame.namespace:
-            return frame.namespace[variable]
-        frame = frame.parent
-    raise SchemeNameError
-
 #############################
 # Functions #
 #############################
 
+# most frames a pool keeps for reuse; deeper recursion allocates as usual
+FRAME_POOL_SIZE = 32
+
 class Function:
-    def __init__(self, param_list, expr, enclosing_frame):
+    def __init__(self, param_list, expr, enclosing_frame, code=None, slotted=False, scope=None,
+                 pooled=False):
         self.param = tuple(param_list)
         self.expr = expr
         self.frame = enclosing_frame
+        # the Scope expr was compiled in, so it can be compiled again after
+        # pickling (see __setstate__)
+        self.scope = scope
+        if code is None:
+            code, slotted = compile_body(self.param, expr, scope)
+            pooled = slotted and not captures_frame(expr)
+        self.code = code
+        self.slotted = slotted
+        # SlotFrames from finished calls, if no frame of this function can
+        # outlive its call (see captures_frame); None otherwise
+        self.pool = [] if pooled else None
+        # set by the define that first binds this function (for profiling)
+        self.name = None
 
     def __call__(self, *args):
+        func = self
+        budget = ACTIVE_BUDGETS and current_budget()
+        while True:
+            if budget:
+                try:
+                    next(budget.step_ticks)
+                except StopIteration:
+                    budget.over(steps=1)
+            frame = func.new_frame(args)
+            result = func.code(frame)
+            if func.pool is not None:
+                func.free_frame(frame)
+            if type(result) is not TailCall:
+                return result
+            func, args = result.func, result.args
+
+    def new_frame(self, args):
+        """
+        The frame for a call with args, taken from the pool if there is one.
+        """
         if len(args) != len(self.param):
             raise SchemeEvaluationError
-        new_frame = Frame(self.frame)
-        for (param, val) in zip(self.param, args):
-            new_frame.namespace[param] = val
-        return evaluate(self.expr, new_frame)
+        if self.pool is not None:
+            # pop, not a check and then a pop, since another thread can
+            # empty the pool in between
+            try:
+                frame = self.pool.pop()
+                frame.parent, frame.slots = self.frame, list(args)
+                return frame
+            except IndexError:
+                pass
+        if self.slotted:
+            return SlotFrame(self.frame, list(args))
+        return Frame(self.frame, dict(zip(self.param, args)))
+
+    def free_frame(self, frame):
+        """
+        Return a pooled frame once its call is over.  It's emptied first, so
+        the pool doesn't keep the call's arguments alive.
+        """
+        if len(self.pool) < FRAME_POOL_SIZE:
+            frame.parent = frame.slots = None
+            self.pool.append(frame)
     
+    def __getstate__(self):
+        # compiled code is a closure and can't be pickled, and pooled frames
+        # aren't worth sending
+        state = self.__dict__.copy()
+        del state["code"]
+        state["pool"] = self.pool is not None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pool = [] if state["pool"] else None
+        self.code = self.compile_on_first_call
+
+    def compile_on_first_call(self, frame):
+        # a loaded Function is only compiled if it is called, so loading
+        # many of them (see load_image) stays cheap
+        self.code, _ = compile_body(self.param, self.expr, self.scope)
+        return self.code(frame)
+
     def __str__(self):
         return f"( lambda {str(self.param)} ({self.expr}))"
 
-def create_function(arg, expr, frame):
-    new_func = Function(arg, expr, frame)
+def create_function(arg, expr, frame, code=None, slotted=False, scope=None, pooled=False):
+    new_func = Function(arg, expr, frame, code, slotted, scope, pooled)
     return new_func
 
+def compile_body(names, body, scope, tail=True):
+    """
+    Compile the body of a function or let that binds names, returning the
+    code and whether its frames can be SlotFrames.
+    """
+    body_scope = Scope(None if changes_shape(body) else names, scope)
+    return compile_expr(body, body_scope, tail), body_scope.slots is not None
+
+class TailCall:
+    """
+    A call to a Function in tail position, returned to the caller's
+    Function.__call__ loop instead of being made on the Python stack.
+    """
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+
+def compile_lambda(tree, scope=None, tail=False):
+    if len(tree) < 3 or not isExpression(tree[1]):
+        return compile_error()
+    params, body = tree[1], tree[2]
+    code, slotted = compile_body(params, body, scope)
+    pooled = slotted and not captures_frame(body)
+    return lambda frame: create_function(params, body, frame, code, slotted, scope, pooled)
+
+def compile_define(tree, scope=None, tail=False):
+    if len(tree) < 3:
+        return compile_error()
+    if not isExpression(tree[1]):
+        name = tree[1]
+        value_code = compile_expr(tree[2], scope)
+    else:
+        if not tree[1]:
+            return compile_error()
+        name = tree[1][0]
+        value_code = compile_lambda(["lambda", tree[1][1:], tree[2]], scope)
+
+    def define(frame):
+        value = value_code(frame)
+        if isinstance(value, Function) and value.name is None:
+            value.name = name
+        return create_variable(name, value, frame)
+    return define
+
 #############################
 # Conditionals #
 #############################
@@ -207,10 +627,16 @@ booleans_rev = {
     False: "#f",
 }
 
-def evaluate_conditional(pred, true_expr, false_expr, frame):
-    if evaluate(pred, frame):
-        return evaluate(true_expr, frame)
-    return evaluate(false_expr, frame)
+def compile_if(tree, scope=None, tail=False):
+    if len(tree) < 4:
+        return compile_error()
+    pred = compile_expr(tree[1], scope)
+    true_code, false_code = compile_all(tree[2:4], scope, tail)
+    def conditional(frame):
+        if pred(frame):
+            return true_code(frame)
+        return false_code(frame)
+    return conditional
 
 def list_compare(func, args):
     n = len(args)
@@ -221,11 +647,16 @@ def list_compare(func, args):
             return False
     return True
 
-def list_iter(crit_bool, args, frame):
-    for x in args:
-        if evaluate(x, frame) == crit_bool:
-            return crit_bool
-    return not crit_bool
+def compile_list_iter(crit_bool):
+    def compile_combinator(tree, scope=None, tail=False):
+        codes = compile_all(tree[1:], scope)
+        def combinator(frame):
+            for code in codes:
+                if code(frame) == crit_bool:
+                    return crit_bool
+            return not crit_bool
+        return combinator
+    return compile_combinator
 
 def negate(*args):
     if len(args) != 1:
@@ -238,8 +669,8 @@ comparison_builtins = {
     ">=" : lambda *args: list_compare( (lambda x, y: x >= y), args),
     "<" : lambda *args: list_compare( (lambda x, y: x < y), args),
     "<=" : lambda *args: list_compare( (lambda x, y: x <= y), args),
-    "and" : lambda args, frame: list_iter(False, args, frame), ##special form
-    "or" : lambda args, frame: list_iter(True, args, frame), ##special form
+    "and" : compile_list_iter(False), ##special form
+    "or" : compile_list_iter(True), ##special form
     "not" : negate,
 }
 
@@ -248,19 +679,63 @@ comparison_builtins = {
 #############################
 
 class Pair:
+    """
+    A cons cell.  Each pair also records the length of the list it starts,
+    or None if that list is improper, so length and list? are constant time.
+    """
+    __slots__ = ("car", "cdr", "length")
     EMPTY_LIST = None
+    cached_lengths = True
 
     def __init__(self, car, cdr):
         self.car = car
         self.cdr = cdr
+        if cdr is None:
+            self.length = 1
+        elif type(cdr) is Pair and cdr.length is not None:
+            self.length = cdr.length + 1
+        else:
+            self.length = None
+
+    def set_cdr(self, cdr):
+        """
+        Changing a cdr changes the length of every list that shares this
+        pair, so cached lengths are no longer trusted once it happens.
+        """
+        Pair.cached_lengths = False
+        self.cdr = cdr
+        self.length = None
 
     def __str__(self):
-        return f'({self.car}, {self.cdr})'
+        cars = []
+        cons = self
+        while isinstance(cons, Pair):
+            cars.append(f'({cons.car}, ')
+            cons = cons.cdr
+        return "".join(cars) + f'{cons}' + ")" * len(cars)
     
     def __eq__(self, other):
-        if type(self) != type(other):
-            return False
-        return self.car == other.car and self.cdr == other.cdr
+        this = self
+        while isinstance(this, Pair):
+            if type(this) != type(other) or not this.car == other.car:
+                return False
+            this, other = this.cdr, other.cdr
+        return this == other
+
+    def __reduce__(self):
+        # pickled as a flat list of cars, not one nested pickle per pair,
+        # so long lists don't hit the recursion limit
+        cars = []
+        cons = self
+        while isinstance(cons, Pair):
+            cars.append(cons.car)
+            cons = cons.cdr
+        return rebuild_list, (cars, cons)
+
+def rebuild_list(cars, tail):
+    for car in reversed(cars):
+        tail = Pair(car, tail)
+    return tail
 
 def isCons(obj):
     return isinstance(obj, Pair)
@@ -268,6 +743,15 @@ def isCons(obj):
 def create_pair(*args):
     if len(args) != 2:
         raise SchemeEvaluationError
+    # Pairs are counted against a Budget here and in create_list, which
+    # is where Scheme code makes them
+    if ACTIVE_BUDGETS:
+        budget = current_budget()
+        if budget is not None:
+            try:
+                next(budget.pair_ticks)
+            except StopIteration:
+                budget.over(pairs=1)
     return Pair(args[0], args[1])
 
 def get_pair_elem(elem_num, args):
@@ -278,57 +762,60 @@ def get_pair_elem(elem_num, args):
     return args[0].cdr
 
 def create_list(*args):
+    if ACTIVE_BUDGETS:
+        budget_charge(len(args))
     list = Pair.EMPTY_LIST
-    for i in range(len(args)-1, -1, -1):
-        list = create_pair(args[i], list)
+    for elem in reversed(args):
+        list = Pair(elem, list)
     return list
 
 def isList(arg):
-    if arg is Pair.EMPTY_LIST:
-        return True
-    return isinstance(arg, Pair) and isList(arg.cdr)
+    if type(arg) is Pair and Pair.cached_lengths:
+        return arg.length is not None
+    while isinstance(arg, Pair):
+        arg = arg.cdr
+    return arg is Pair.EMPTY_LIST
 
 def length_list(arg):
-    if arg == Pair.EMPTY_LIST:
-        return 0
-    if not isinstance(arg, Pair):
-        return 1
-    return 1 + length_list(arg.cdr)
+    if type(arg) is Pair and Pair.cached_lengths and arg.length is not None:
+        return arg.length
+    length = 0
+    while isinstance(arg, Pair):
+        length += 1
+        arg = arg.cdr
+    if arg != Pair.EMPTY_LIST:
+        length += 1
+    return length
 
 def get_list_elem(cons, index):
+    while index != 0:
+        if not isinstance(cons, Pair):
+            raise SchemeEvaluationError
+        cons = cons.cdr
+        index -= 1
     if not isinstance(cons, Pair):
         raise SchemeEvaluationError
-    if index == 0:
-        return cons.car
-    return get_list_elem(cons.cdr, index-1)
-
-def get_last_pair_list(list):
-    if list.cdr is Pair.EMPTY_LIST:
-        return list
-    return get_last_pair_list(list.cdr)
-
-def extend_list(list, elem):
-    list.cdr = create_pair(elem, None)
+    return cons.car
+
+def list_elems(list):
+    """
+    The elements of a proper list, as a Python list.
+    """
+    elems = []
+    while list is not Pair.EMPTY_LIST:
+        elems.append(list.car)
+        list = list.cdr
+    return elems
 
 def append_lists(*args):
-    if len(args) == 0:
-        return Pair.EMPTY_LIST
     for list in args:
         if not isList(list):
             raise SchemeEvaluationError
-
-    prev = create_pair(None, create_pair(None, None))
-    new_list = prev.cdr
-    cur = new_list
+    elems = []
     for list in args:
-        while list is not Pair.EMPTY_LIST:
-            cur.car = list.car
-            extend_list(cur, None)
-            prev, cur, list = prev.cdr, cur.cdr, list.cdr 
-    prev.cdr = None
-    if new_list.car == None:
-        new_list = Pair.EMPTY_LIST
-    return new_list
+        elems.extend(list_elems(list))
+    budget_reserve(len(elems))
+    return create_list(*elems)
 
 def isListWrapper(*args):
     if len(args) != 1:
@@ -348,6 +835,60 @@ def listItemWrapper(*args):
         raise SchemeEvaluationError
     return get_list_elem(args[0], args[1])
 
+def callable_for(func, list):
+    """
+    The function map/filter/reduce will call on the elements of list; it
+    is only required to be callable if there is some element to call it on.
+    """
+    if not isList(list):
+        raise SchemeEvaluationError
+    if list is not Pair.EMPTY_LIST and not callable(func):
+        raise SchemeEvaluationError
+    return func
+
+def map_list(*args):
+    if len(args) != 2:
+        raise SchemeEvaluationError
+    func, list = args
+    func = callable_for(func, list)
+    elems = list_elems(list)
+    budget_reserve(len(elems))
+    return create_list(*[func(elem) for elem in budget_elems(elems)])
+
+def filter_list(*args):
+    if len(args) != 2:
+        raise SchemeEvaluationError
+    func, list = args
+    func = callable_for(func, list)
+    elems = [elem for elem in budget_elems(list_elems(list)) if func(elem) == True]
+    return create_list(*elems)
+
+def reduce_list(*args):
+    if len(args) != 3:
+        raise SchemeEvaluationError
+    func, list, result = args
+    func = callable_for(func, list)
+    for elem in budget_elems(list_elems(list)):
+        result = func(result, elem)
+    return result
+
+def range_list(*args):
+    if not 1 <= len(args) <= 3 or not all(isNum(arg) for arg in args):
+        raise SchemeEvaluationError
+    start, stop, step = 0, args[0], 1
+    if len(args) > 1:
+        start, stop = args[0], args[1]
+    if len(args) > 2:
+        step = args[2]
+    if step == 0:
+        raise SchemeEvaluationError
+    budget_reserve(max(0, (stop - start) / step))
+    return create_list(*budget_elems(range_elems(start, stop, step)))
+
+def range_elems(start, stop, step):
+    while (start < stop) if step > 0 else (start > stop):
+        yield start
+        start += step
 
 list_builtins = {
     "cons": create_pair,
@@ -357,76 +898,974 @@ list_builtins = {
     "list?": isListWrapper,
     "length": listLengthWrapper,
     "list-ref": listItemWrapper,
-    "append": append_lists
+    "append": append_lists,
+    "map": map_list,
+    "filter": filter_list,
+    "reduce": reduce_list,
+    "range": range_list,
     }
 
+#############################
+# Vectors #
+#############################
+
+class Vector:
+    """
+    A fixed-length, mutable sequence backed by a Python list, so indexing
+    is constant time (unlike list-ref on a chain of Pairs).
+    """
+    __slots__ = ("elems",)
+
+    def __init__(self, elems):
+        self.elems = elems
+
+    def __str__(self):
+        return "#(" + " ".join(str(elem) for elem in self.elems) + ")"
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.elems == other.elems
+
+def isVector(obj):
+    return isinstance(obj, Vector)
+
+def isVectorWrapper(*args):
+    if len(args) != 1:
+        raise SchemeEvaluationError
+    return isVector(args[0])
+
+def vector_index(vec, index):
+    if not isVector(vec) or not isInteger(index):
+        raise SchemeEvaluationError
+    if not 0 <= index < len(vec.elems):
+        raise SchemeEvaluationError
+    return int(index)
+
+def make_vector(*args):
+    if len(args) not in {1, 2}:
+        raise SchemeEvaluationError
+    size, fill = args[0], (args[1] if len(args) == 2 else 0)
+    if not isInteger(size) or size < 0:
+        raise SchemeEvaluationError
+    budget_charge(size)
+    return Vector([fill] * int(size))
+
+def vector_ref(*args):
+    if len(args) != 2:
+        raise SchemeEvaluationError
+    vec, index = args
+    index = vector_index(vec, index)
+    return vec.elems[index]
+
+def vector_set(*args):
+    if len(args) != 3:
+        raise SchemeEvaluationError
+    vec, index, value = args
+    index = vector_index(vec, index)
+    vec.elems[index] = value
+    return value
+
+def vector_length(*args):
+    if len(args) != 1 or not isVector(args[0]):
+        raise SchemeEvaluationError
+    return len(args[0].elems)
+
+def vector_to_list(*args):
+    if len(args) != 1 or not isVector(args[0]):
+        raise SchemeEvaluationError
+    return create_list(*args[0].elems)
+
+def list_to_vector(*args):
+    if len(args) != 1 or not isList(args[0]):
+        raise SchemeEvaluationError
+    return Vector(list_elems(args[0]))
+
+vector_builtins = {
+    "vector": lambda *args: Vector(list(args)),
+    "make-vector": make_vector,
+    "vector?": isVectorWrapper,
+    "vector-ref": vector_ref,
+    "vector-set!": vector_set,
+    "vector-length": vector_length,
+    "vector->list": vector_to_list,
+    "list->vector": list_to_vector,
+}
+
+#############################
+# Hash Tables #
+#############################
+
+class HashTable:
+    """
+    A mutable table from keys to values backed by a Python dict, so lookups
+    are constant time (unlike searching an association list).  Keys can be
+    numbers, booleans, symbols and lists of those; each one is stored under
+    hash_key(key) alongside the key itself, which hash-keys hands back.
+    """
+    __slots__ = ("table",)
+
+    def __init__(self):
+        self.table = {}
+
+    def __str__(self):
+        return "#hash(" + " ".join(f"({key} . {value})" for key, value in self.table.values()) + ")"
+
+def hash_key(key):
+    """
+    A dict key for a Scheme value.  Booleans are tagged so #t and 1 don't
+    share an entry, and lists are copied into tuples, so they are hashed by
+    their contents.  Anything mutable (vectors, tables) or without a
+    meaningful equality (functions) can't be a key.
+    """
+    if key is True or key is False:
+        return (bool, key)
+    if isNum(key) or isStr(key) or key is Pair.EMPTY_LIST:
+        return key
+    if isCons(key):
+        cars = []
+        while isCons(key):
+            cars.append(hash_key(key.car))
+            key = key.cdr
+        return (Pair, tuple(cars), hash_key(key))
+    raise SchemeEvaluationError
+
+def isHash(obj):
+    return isinstance(obj, HashTable)
+
+def make_hash(*args):
+    """
+    (make-hash) or (make-hash alist), where alist is a list of (key . value)
+    pairs to start the table with.
+    """
+    if len(args) > 1:
+        raise SchemeEvaluationError
+    table = HashTable()
+    if args:
+        if not isList(args[0]):
+            raise SchemeEvaluationError
+        for pair in list_elems(args[0]):
+            if not isCons(pair):
+                raise SchemeEvaluationError
+            table.table[hash_key(pair.car)] = (pair.car, pair.cdr)
+    return table
+
+def hash_ref(*args):
+    """
+    (hash-ref table key [default]); without a default, a missing key is an
+    error.
+    """
+    if len(args) not in {2, 3} or not isHash(args[0]):
+        raise SchemeEvaluationError
+    entry = args[0].table.get(hash_key(args[1]))
+    if entry is not None:
+        return entry[1]
+    if len(args) == 3:
+        return args[2]
+    raise SchemeEvaluationError
+
+def hash_set(*args):
+    if len(args) != 3 or not isHash(args[0]):
+        raise SchemeEvaluationError
+    table, key, value = args
+    table.table[hash_key(key)] = (key, value)
+    return value
+
+def hash_has_key(*args):
+    if len(args) != 2 or not isHash(args[0]):
+        raise SchemeEvaluationError
+    return hash_key(args[1]) in args[0].table
+
+def hash_keys(*args):
+    if len(args) != 1 or not isHash(args[0]):
+        raise SchemeEvaluationError
+    return create_list(*[key for key, _ in args[0].table.values()])
+
+def hash_count(*args):
+    if len(args) != 1 or not isHash(args[0]):
+        raise SchemeEvaluationError
+    return len(args[0].table)
+
+def isHashWrapper(*args):
+    if len(args) != 1:
+        raise SchemeEvaluationError
+    return isHash(args[0])
+
+hash_builtins = {
+    "make-hash": make_hash,
+    "hash?": isHashWrapper,
+    "hash-ref": hash_ref,
+    "hash-set!": hash_set,
+    "hash-has-key?": hash_has_key,
+    "hash-keys": hash_keys,
+    "hash-count": hash_count,
+}
+
+#############################
+# Memoization #
+#############################
+
+MEMO_SIZE = 1024
+
+def memo_key(value):
+    """
+    A cache key for a Scheme value: like hash_key, but every value is tagged
+    with its type (so (list 1) and (list 1.0) differ too).  Only values that
+    can't change have keys; anything else (vectors, hash tables, functions)
+    raises TypeError, and the call isn't cached.
+    """
+    if isCons(value):
+        cars = []
+        while isCons(value):
+            cars.append(memo_key(value.car))
+            value = value.cdr
+        return (Pair, tuple(cars), memo_key(value))
+    if type(value) is float:
+        return (float, repr(value))  # so -0.0 isn't 0.0
+    if value is Pair.EMPTY_LIST or isinstance(value, (int, Fraction, str)):
+        return (type(value), value)
+    raise TypeError(f"{type(value).__name__} can't be a memo key")
+
+class MemoizedFunction:
+    """
+    A function whose results are cached by argument value, keeping at most
+    size of them and evicting the least recently used first.  Arguments are
+    keyed along with their types so that 1, 1.0 and #t don't share an entry,
+    and lists by their contents, typed the same way (see memo_key).  Calls
+    with an argument that can change, like a vector or hash table, just run
+    func.
+    """
+    def __init__(self, func, size=MEMO_SIZE):
+        self.func = func
+        self.size = size
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, *args):
+        try:
+            key = tuple(memo_key(arg) for arg in args)
+            result = self.cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            self.misses += 1
+            return self.func(*args)
+        else:
+            self.hits += 1
+            try:
+                self.cache.move_to_end(key)
+            except KeyError:  # evicted by another thread meanwhile
+                pass
+            return result
+
+        self.misses += 1
+        result = self.func(*args)
+        self.cache[key] = result
+        if len(self.cache) > self.size:
+            try:
+                self.cache.popitem(last=False)
+            except KeyError:
+                pass
+        return result
+
+    def __getstate__(self):
+        # cached arguments can be lists, which can't be hashed until they
+        # are fully loaded (see ImagePickler), so the cache starts over
+        state = self.__dict__.copy()
+        state["cache"] = collections.OrderedDict()
+        return state
+
+    def __str__(self):
+        return f"(memoized {self.func})"
+
+def memo_size(size):
+    if not isInteger(size) or size < 1:
+        raise SchemeEvaluationError
+    return int(size)
+
+def memoize(*args):
+    if len(args) not in {1, 2} or not callable(args[0]):
+        raise SchemeEvaluationError
+    size = memo_size(args[1]) if len(args) == 2 else MEMO_SIZE
+    return MemoizedFunction(args[0], size)
+
+def compile_define_memo(tree, scope=None, tail=False):
+    """
+    (define-memo (name params...) body [size]) defines name as a memoized
+    function, so its recursive calls to name also go through the cache.
+    """
+    if len(tree) not in {3, 4} or not isExpression(tree[1]) or not tree[1]:
+        return compile_error()
+    name = tree[1][0]
+    lambda_code = compile_lambda(["lambda", tree[1][1:], tree[2]], scope)
+    size_code = compile_expr(tree[3], scope) if len(tree) == 4 else lambda frame: MEMO_SIZE
+
+    def define_memo(frame):
+        func = lambda_code(frame)
+        func.name = name
+        return create_variable(name, MemoizedFunction(func, memo_size(size_code(frame))), frame)
+    return define_memo
+
+def memo_stat(attribute):
+    def stat(*args):
+        if len(args) != 1 or not isinstance(args[0], MemoizedFunction):
+            raise SchemeEvaluationError
+        return getattr(args[0], attribute)
+    return stat
+
+memo_builtins = {
+    "memoize": memoize,
+    "memo-hits": memo_stat("hits"),
+    "memo-misses": memo_stat("misses"),
+}
+
+#############################
+# Parallel Map #
+#############################
+
+class ValuePickler(pickle.Pickler):
+    """
+    Pickles Scheme values for another process, including Functions and the
+    chain of frames they close over.  Builtins and the global frame are
+    pickled by name, so they become the receiving process's own, and a
+    Function's code is compiled again when it is loaded.
+    """
+    def __init__(self, file):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.builtin_names = {id(value): name for name, value in BUILTINS.items()}
+
+    def reducer_override(self, obj):
+        if obj is GLOBAL_FRAME:
+            return global_frame, ()
+        if obj is BASE_FRAME:
+            return base_frame, ()
+        name = self.builtin_names.get(id(obj))
+        if name is not None:
+            return builtin, (name,)
+        return NotImplemented
+
+def global_frame():
+    return GLOBAL_FRAME
+
+def base_frame():
+    return BASE_FRAME
+
+def builtin(name):
+    return BUILTINS[name]
+
+def dump_value(value):
+    file = io.BytesIO()
+    ValuePickler(file).dump(value)
+    return file.getvalue()
+
+def load_value(data):
+    return pickle.loads(data)
+
+PMAP_POOL = None
+PMAP_WORKERS = os.cpu_count() or 1
+IN_PMAP_WORKER = False
+
+def start_pmap_worker():
+    global IN_PMAP_WORKER, ACTIVE_BUDGETS
+    IN_PMAP_WORKER = True
+    # a worker forked while some thread had a Budget or was running an
+    # Interpreter must not inherit either
+    BUDGET.set(None)
+    SESSION.set(None)
+    ACTIVE_BUDGETS = 0
+
+def pmap_pool():
+    """
+    The worker processes pmap runs on, started the first time they're needed.
+    """
+    global PMAP_POOL
+    if PMAP_POOL is None:
+        # imported here so that programs that never call pmap don't pay for it
+        import atexit
+        import multiprocessing
+        PMAP_POOL = multiprocessing.Pool(PMAP_WORKERS, initializer=start_pmap_worker)
+        atexit.register(PMAP_POOL.terminate)
+    return PMAP_POOL
+
+def in_daemon_process():
+    """
+    Whether this is a daemonic multiprocessing worker (like batch.py's),
+    which isn't allowed to start a pool of its own.
+    """
+    # a process multiprocessing started has it imported already
+    multiprocessing = sys.modules.get("multiprocessing")
+    return multiprocessing is not None and multiprocessing.current_process().daemon
+
+def pmap_chunk(func_data, elems_data):
+    func = load_value(func_data)
+    return dump_value([func(elem) for elem in load_value(elems_data)])
+
+def pmap_list(*args):
+    """
+    map, with the elements split into chunks that are mapped by worker
+    processes.  Results come back in order, and an error is raised for the
+    first element that raises one, as with map.  func runs in the workers,
+    so any variables it changes with set! or define are not changed here.
+    Falls back to map for a single element, inside a worker (pmap's or any
+    other daemonic process's), under a Budget (so its limits still hold), in
+    an Interpreter that has set! prelude globals (which the workers couldn't
+    see), or when func can't be pickled.
+    """
+    if len(args) != 2:
+        raise SchemeEvaluationError
+    func, list = args
+    func = callable_for(func, list)
+    elems = list_elems(list)
+    session = SESSION.get()
+    if (len(elems) < 2 or IN_PMAP_WORKER or in_daemon_process()
+            or current_budget() is not None or (session is not None and session.overlay)):
+        return create_list(*[func(elem) for elem in elems])
+    try:
+        func_data = dump_value(func)
+        size = -(-len(elems) // (4 * PMAP_WORKERS))
+        chunks = [dump_value(elems[i:i + size]) for i in range(0, len(elems), size)]
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return create_list(*[func(elem) for elem in elems])
+
+    results = []
+    for data in pmap_pool().imap(functools.partial(pmap_chunk, func_data), chunks):
+        results.extend(load_value(data))
+    return create_list(*results)
+
+pmap_builtins = {
+    "pmap": pmap_list,
+}
+
+#############################
+# Images #
+#############################
+
+# the version is part of the header, so images from an older layout are
+# rejected instead of loading wrongly
+IMAGE_HEADER = b"6101 scheme image 1\n"
+
+class ImagePickler(ValuePickler):
+    """
+    Pickles a frame chain for save_image.  Pairs are written as references
+    (see persistent_id), and their cells come afterwards as flat records,
+    so a long list doesn't nest one pickle inside another for each pair,
+    and lists that share a tail or contain themselves keep their shape.
+    """
+    def __init__(self, file):
+        super().__init__(file)
+        self.pair_ids = {}
+        self.pairs = []
+
+    def persistent_id(self, obj):
+        if type(obj) is not Pair:
+            return None
+        index = self.pair_ids.get(id(obj))
+        if index is None:
+            index = len(self.pairs)
+            # the rest of the list is numbered now too, so its cells are
+            # written one after another and their cdrs can be left out
+            while type(obj) is Pair and id(obj) not in self.pair_ids:
+                self.pair_ids[id(obj)] = len(self.pairs)
+                self.pairs.append(obj)
+                obj = obj.cdr
+        return index
+
+    def dump_pairs(self):
+        # writing one batch of cells can reach pairs not seen yet, which go
+        # in the next batch; the memo is shared, so nothing is written twice
+        done = 0
+        while done < len(self.pairs):
+            start, done = done, len(self.pairs)
+            cars, tails = [], {}
+            for index in range(start, done):
+                pair = self.pairs[index]
+                cars.append(pair.car)
+                if index + 1 == done or pair.cdr is not self.pairs[index + 1]:
+                    tails[index] = (pair.cdr, pair.length)
+            self.dump((cars, tails))
+        self.dump(None)
+
+class ImageUnpickler(pickle.Unpickler):
+    def __init__(self, file):
+        super().__init__(file)
+        self.pairs = []
+
+    def persistent_load(self, index):
+        while len(self.pairs) <= index:
+            self.pairs.append(Pair.__new__(Pair))
+        return self.pairs[index]
+
+    def load_pairs(self):
+        start = 0
+        while (batch := self.load()) is not None:
+            cars, tails = batch
+            end = start + len(cars)
+            self.persistent_load(end - 1)
+            # backwards, so each cell's cdr already has its length
+            for index in range(end - 1, start - 1, -1):
+                pair = self.pairs[index]
+                pair.car = cars[index - start]
+                if index in tails:
+                    pair.cdr, pair.length = tails[index]
+                else:
+                    pair.cdr = self.pairs[index + 1]
+                    pair.length = None if pair.cdr.length is None else pair.cdr.length + 1
+            start = end
+
+def save_image(frame, filename):
+    """
+    Write frame, the frames above it and everything they refer to
+    (functions and what they close over, lists, vectors, tables) to
+    filename.  The global frame and builtins are saved by name.
+    """
+    with open(filename + ".tmp", "wb") as f:
+        f.write(IMAGE_HEADER)
+        pickler = ImagePickler(f)
+        pickler.dump((frame, Pair.cached_lengths))
+        pickler.dump_pairs()
+    os.replace(filename + ".tmp", filename)
+
+def load_image(filename):
+    """
+    The frame saved in filename by save_image, as a new frame whose parents
+    end at this process's global frame.  Functions in it are compiled when
+    they are first called.
+    """
+    with open(filename, "rb") as f:
+        if f.readline() != IMAGE_HEADER:
+            raise ValueError(f"{filename} is not a Scheme image (or is from another version)")
+        unpickler = ImageUnpickler(f)
+        frame, cached_lengths = unpickler.load()
+        unpickler.load_pairs()
+    if not cached_lengths:
+        Pair.cached_lengths = False
+    return frame
+
 #############################
 # Reading from Files #
 #############################
 
-def evaluate_file(filename: str, frame=None):
-    file = open(filename)
-    expr = file.read()
-    return evaluate(parse(tokenize(expr)), frame)
+def evaluate_stream(stream, frame=None):
+    """
+    Evaluate each top-level expression of a text stream in turn, starting
+    as soon as it has been read, and return the value of the last one.
+    """
+    if frame == None:
+        frame = make_initial_frame()
+    result = None
+    nodes = {}
+    for expr in parse_stream(tokenize_stream(stream)):
+        result = evaluate(compact(expr, nodes), frame)
+    return result
+
+CACHE_DIRECTORY = "__schemecache__"
+# bump whenever parsing or compact changes what it makes of a file, so
+# entries written before are read as misses
+CACHE_VERSION = 4
+
+def cache_path(filename):
+    directory, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(directory, CACHE_DIRECTORY, name + ".pickle")
+
+def load_cached_expressions(filename):
+    """
+    The parsed top-level expressions of filename from its cache entry, or
+    None if there is no entry or the file has changed since it was written.
+    An entry is trusted if the file's mtime and size match; otherwise the
+    file is hashed, and a matching hash (e.g. after a touch) refreshes the
+    entry's mtime.
+    """
+    try:
+        with open(cache_path(filename), "rb") as f:
+            entry = pickle.load(f)
+    except Exception:  # missing, truncated, or from some other version
+        return None
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    if not isinstance(entry, dict) or entry.get("version") != CACHE_VERSION or \
+            entry.get("path") != os.path.abspath(filename):
+        return None
+    if (entry["mtime"], entry["size"]) == (stat.st_mtime_ns, stat.st_size):
+        return entry["exprs"]
+    with open(filename, "rb") as f:
+        # stat what was read, not whatever may have been written since
+        stat = os.fstat(f.fileno())
+        if hashlib.sha256(f.read()).hexdigest() != entry["hash"]:
+            return None
+    store_cached_expressions(filename, stat, entry["hash"], entry["exprs"])
+    return entry["exprs"]
+
+def store_cached_expressions(filename, stat, digest, exprs):
+    """
+    Write the cache entry for filename, whose contents when it had stat (an
+    os.stat_result) hashed to digest and parsed to exprs.  Each write goes
+    to a temporary file of its own first, so processes caching the same
+    file at once don't clobber each other's entries.
+    """
+    path = cache_path(filename)
+    entry = {
+        "version": CACHE_VERSION,
+        "path": os.path.abspath(filename),
+        "mtime": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "hash": digest,
+        "exprs": exprs,
+    }
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+def parse_file(filename, use_cache=True):
+    """
+    The list of parsed (and compacted) top-level expressions in filename,
+    read from (and saved to) its entry in the CACHE_DIRECTORY next to it if
+    use_cache.
+    """
+    if use_cache:
+        exprs = load_cached_expressions(filename)
+        if exprs is not None:
+            return exprs
+    with open(filename, "rb") as f:
+        stat = os.fstat(f.fileno())
+        source = f.read()
+    nodes = {}
+    exprs = [compact(expr, nodes) for expr in parse_stream(tokenize(source.decode()))]
+    if use_cache:
+        store_cached_expressions(filename, stat, hashlib.sha256(source).hexdigest(), exprs)
+    return exprs
+
+def evaluate_file(filename: str, frame=None, use_cache=False, budget=None):
+    """
+    Evaluate the expressions in filename, returning the value of the last
+    one.  By default the file is streamed; with use_cache, parsed
+    expressions come from the file's cache entry when it is up to date.
+    A budget limits the whole file, not each expression.
+    """
+    if budget is not None:
+        with budget:
+            return evaluate_file(filename, frame, use_cache)
+    if not use_cache:
+        with open(filename) as file:
+            return evaluate_stream(file, frame)
+    if frame == None:
+        frame = make_initial_frame()
+    result = None
+    for expr in parse_file(filename):
+        result = evaluate(expr, frame)
+    return result
 
 
 #############################
 # Variable-Binding #
 #############################
 
-def delete_variable(*args):
-    if len(args) != 2:
+def delete_variable(var, frame):
+    if frame.frozen:
         raise SchemeEvaluationError
-    var, frame = args
     if var not in frame.namespace:
         raise SchemeNameError
     val = frame.namespace[var]
     del frame.namespace[var]
+    version_stamp(var)[0] += 1
     return val
 
-def create_local_variable(*args):
-    if len(args) != 3:
-        raise SchemeEvaluationError
-    vars, body, frame = args
-    new_frame = Frame(frame)
-    for var_pair in vars:
-        if len(var_pair) != 2:
-            raise SchemeEvaluationError
-    for [var, val] in vars:
-        new_frame.namespace[var] = evaluate(val, frame)
-    return evaluate(body, new_frame)
-
-def update_variable(*args):
-    if len(args) != 3:
-        raise SchemeEvaluationError
-    var, expr, frame = args
-    new_val = evaluate(expr, frame)
+def update_variable(var, new_val, frame):
+    owner = None
     while frame:
         if var in frame.namespace:
-            frame.namespace[var] = new_val
+            if frame.frozen:
+                # copied on write into the session's overlay, so the change
+                # is only seen in that session
+                if owner is None:
+                    owner = SESSION.get()
+                    if owner is None:
+                        raise SchemeEvaluationError(f"can't set! {var}, which a frozen frame binds")
+                OVERLAID.add(var)
+                owner.overlay.setdefault(frame, {})[var] = new_val
+            else:
+                frame.namespace[var] = new_val
+            version_stamp(var)[0] += 1
             return new_val
+        if frame.copy_on_write and owner is None:
+            owner = frame
         frame = frame.parent
     raise SchemeNameError
 
+def compile_del(tree, scope=None, tail=False):
+    if len(tree) != 2:
+        return compile_error()
+    var = tree[1]
+    return lambda frame: delete_variable(var, frame)
+
+def compile_let(tree, scope=None, tail=False):
+    if len(tree) != 3 or not isExpression(tree[1]):
+        return compile_error()
+    for var_pair in tree[1]:
+        if not isExpression(var_pair) or len(var_pair) != 2:
+            return compile_error()
+    names = [var for var, _ in tree[1]]
+    val_codes = compile_all([val for _, val in tree[1]], scope)
+    body, slotted = compile_body(names, tree[2], scope, tail)
+    if slotted and not captures_frame(tree[2]):
+        # frames of this let can't outlive it, so they're reused
+        pool = []
+        def let(frame):
+            vals = [code(frame) for code in val_codes]
+            try:
+                let_frame = pool.pop()
+                let_frame.parent, let_frame.slots = frame, vals
+            except IndexError:
+                let_frame = SlotFrame(frame, vals)
+            result = body(let_frame)
+            if len(pool) < FRAME_POOL_SIZE:
+                let_frame.parent = let_frame.slots = None
+                pool.append(let_frame)
+            return result
+        return let
+
+    def let(frame):
+        vals = [code(frame) for code in val_codes]
+        if slotted:
+            return body(SlotFrame(frame, vals))
+        return body(Frame(frame, dict(zip(names, vals))))
+    return let
+
+def compile_set(tree, scope=None, tail=False):
+    if len(tree) != 3:
+        return compile_error()
+    var = tree[1]
+    code = compile_expr(tree[2], scope)
+    steps = resolve(var, scope)
+    hops, slot = steps[-1]
+
+    if len(steps) == 1 and slot is not None:
+        def set_slot(frame):
+            new_val = code(frame)
+            walk(frame, hops).slots[slot] = new_val
+            return new_val
+        return set_slot
+
+    def set_variable(frame):
+        new_val = code(frame)
+        for hops, slot in steps:
+            frame = walk(frame, hops)
+            if slot is not None:
+                frame.slots[slot] = new_val
+                return new_val
+            if var in frame.namespace:
+                return update_variable(var, new_val, frame)
+        # from the top-level frame itself, which may be copy_on_write
+        return update_variable(var, new_val, frame)
+    return set_variable
+
 variable_builtins = {
-    "del": delete_variable,
-    "let": create_local_variable,
-    "set!": update_variable,
+    "del": compile_del,
+    "let": compile_let,
+    "set!": compile_set,
 }
 
 #############################
 # Global Variables #
 #############################
 
+def compile_begin(tree, scope=None, tail=False):
+    if len(tree) < 2:
+        return compile_error()
+    codes = compile_all(tree[1:-1], scope)
+    last = compile_expr(tree[-1], scope, tail)
+    def begin(frame):
+        for code in codes:
+            code(frame)
+        return last(frame)
+    return begin
+
 frame_builtins = {
-    "define": lambda: None,
-    "lambda": create_function,
-    "if": evaluate_conditional,
-    "begin": lambda: None,
+    "define": compile_define,
+    "lambda": compile_lambda,
+    "if": compile_if,
+    "begin": compile_begin,
+    "define-memo": compile_define_memo,
 }
 
-GLOBAL_FRAME = Frame(None, scheme_builtins | comparison_builtins \
-                      | frame_builtins | list_builtins | variable_builtins)
+BUILTINS = scheme_builtins | comparison_builtins | frame_builtins | list_builtins \
+           | vector_builtins | hash_builtins | memo_builtins | pmap_builtins \
+           | variable_builtins
+
+GLOBAL_FRAME = Frame(None, dict(BUILTINS))
+
+def freeze(frame):
+    """
+    Make frame's bindings read-only, so it can be shared by Interpreters
+    running on different threads.  Returns frame.
+    """
+    frame.frozen = True
+    frame.copy_on_write = False
+    return frame
+
+# the builtins every Interpreter starts from; unlike GLOBAL_FRAME, no one
+# can rebind them here
+BASE_FRAME = freeze(Frame(None, dict(BUILTINS)))
+
+#############################
+# Lexical Addressing #
+#############################
+
+class Scope:
+    """
+    Compile-time picture of a frame: the slot index of each name for a
+    SlotFrame, or None for a Frame whose names are only known at runtime.
+    """
+    def __init__(self, names, parent):
+        self.slots = None
+        if names is not None:
+            self.slots = {name: index for index, name in enumerate(names)}
+        self.parent = parent
+
+def captures_frame(tree):
+    """
+    Whether evaluating tree can keep a reference to the frame it runs in
+    after it finishes, i.e. whether it makes a function (which closes over
+    that frame, or a let frame inside it).  If not, the frame is free for
+    reuse as soon as tree is done.
+    """
+    if not isExpression(tree) or not tree:
+        return False
+    if isStr(tree[0]) and tree[0] in {"lambda", "define", "define-memo"}:
+        return True
+    return any(captures_frame(sub) for sub in tree)
+
+def changes_shape(tree):
+    """
+    Whether evaluating tree can add or remove names in the frame it runs in,
+    i.e. whether it contains define or del outside of a nested lambda or
+    let body.
+    """
+    if not isExpression(tree) or not tree:
+        return False
+    first_elem = tree[0]
+    if isStr(first_elem):
+        if first_elem in {"define", "define-memo", "del"}:
+            return True
+        if first_elem == "lambda":
+            return False
+        if first_elem == "let":
+            if len(tree) != 3 or not isExpression(tree[1]):
+                return False
+            return any(isExpression(var_pair) and len(var_pair) == 2 and
+                       changes_shape(var_pair[1]) for var_pair in tree[1])
+    return any(changes_shape(sub) for sub in tree)
+
+def resolve(name, scope):
+    """
+    Work out where name lives relative to the current frame.  Returns a list
+    of (hops, slot) steps: go up hops parents, then either read that
+    SlotFrame's slot or, if slot is None, check that Frame's namespace.  If
+    no slot step ends the list, the last step is the top-level frame, and
+    lookup carries on up its parents.
+    """
+    steps = []
+    hops = 0
+    while scope is not None:
+        if scope.slots is None:
+            steps.append((hops, None))
+            hops = 1
+        elif name in scope.slots:
+            steps.append((hops, scope.slots[name]))
+            return steps
+        else:
+            hops += 1
+        scope = scope.parent
+    steps.append((hops, None))
+    return steps
+
+def walk(frame, hops):
+    for _ in range(hops):
+        frame = frame.parent
+    return frame
+
+def lookup_chain(name, frame):
+    holder = None
+    while frame is not None:
+        namespace = frame.namespace
+        if name in namespace:
+            if frame.frozen and name in OVERLAID:
+                return overlaid_value(name, frame, namespace[name], holder)
+            return namespace[name]
+        if holder is None and frame.overlay is not None:
+            holder = frame
+        frame = frame.parent
+    raise SchemeNameError
+
+def compile_symbol(name, scope=None):
+    steps = resolve(name, scope)
+    hops, slot = steps[-1]
+
+    if len(steps) == 1 and slot is not None:
+        if hops == 0:
+            return lambda frame: frame.slots[slot]
+        if hops == 1:
+            return lambda frame: frame.parent.slots[slot]
+        if hops == 2:
+            return lambda frame: frame.parent.parent.slots[slot]
+        return lambda frame: walk(frame, hops).slots[slot]
+
+    if len(steps) == 1:
+        # only top-level frames are left to search, and they are the same
+        # ones from call to call, so the value found is cached along with
+        # the frame the search started from and the name's version stamp
+        stamp = version_stamp(name)
+        cached_frame = cached_version = cached_value = None
+
+        def lookup_top(frame):
+            nonlocal cached_frame, cached_version, cached_value
+            for _ in range(hops):
+                frame = frame.parent
+            if frame is cached_frame and stamp[0] == cached_version:
+                return cached_value
+            start = frame
+            holder = None
+            while frame is not None:
+                namespace = frame.namespace
+                if name in namespace:
+                    value = namespace[name]
+                    if frame.frozen and name in OVERLAID:
+                        value = overlaid_value(name, frame, value, holder)
+                        if holder is None or not holder.copy_on_write:
+                            # depends on the running session, not just start
+                            return value
+                    cached_frame, cached_version, cached_value = start, stamp[0], value
+                    return value
+                if holder is None and frame.overlay is not None:
+                    holder = frame
+                frame = frame.parent
+            raise SchemeNameError
+        return lookup_top
+
+    def lookup(frame):
+        for hops, slot in steps[:-1]:
+            frame = walk(frame, hops)
+            if slot is not None:
+                return frame.slots[slot]
+            if name in frame.namespace:
+                return frame.namespace[name]
+        hops, slot = steps[-1]
+        frame = walk(frame, hops)
+        if slot is not None:
+            return frame.slots[slot]
+        return lookup_chain(name, frame)
+    return lookup
 
 #############################
 # Evaluation #
@@ -439,84 +1878,785 @@ def isPair(token):
     return isinstance(token, Pair)
 
 def isNum(token):
-    return isinstance(token, int) or isinstance(token, float)
+    return isinstance(token, (int, float, Fraction))
+
+def isInteger(token):
+    """
+    whether token is a whole number that int() can convert: inf and nan
+    floats are not, since int() raises on them.
+    """
+    if isinstance(token, float) and not math.isfinite(token):
+        return False
+    return isNum(token) and token == int(token)
 
 def isBool(token):
     return (isStr(token) and token in booleans)
 
 def isEmptyList(token):
-    return token == [] or token is None
+    return token == [] or token == () or token is None
 
 def isStr(token):
     return isinstance(token, str)
 
 def isExpression(token):
-    return isinstance(token, list)
+    return isinstance(token, (list, tuple))
 
-def evaluate(tree, frame=None):
-    if frame == None:
-        frame = make_initial_frame()
+special_forms = frame_builtins | variable_builtins | {
+    "and": comparison_builtins["and"],
+    "or": comparison_builtins["or"],
+}
 
-    if isFunc(tree):
-        return tree
+def compile_error(error=SchemeEvaluationError):
+    def fail(frame):
+        raise error
+    return fail
 
-    if isPair(tree):
-        return tree
+def compile_all(trees, scope=None, tail=False):
+    return [compile_expr(tree, scope, tail) for tree in trees]
 
-    if isNum(tree):
-        return tree
-    
+def compile_call(tree, scope=None, tail=False):
+    func_code = compile_expr(tree[0], scope)
+    arg_codes = compile_all(tree[1:], scope)
+
+    def callable_at(frame):
+        func = func_code(frame)
+        if not callable(func):
+            raise SchemeEvaluationError
+        return func
+
+    if tail:
+        return compile_tail_call(callable_at, arg_codes)
+    if len(arg_codes) == 0:
+        return lambda frame: callable_at(frame)()
+    if len(arg_codes) == 1:
+        arg0, = arg_codes
+        return lambda frame: callable_at(frame)(arg0(frame))
+    if len(arg_codes) == 2:
+        arg0, arg1 = arg_codes
+        return lambda frame: callable_at(frame)(arg0(frame), arg1(frame))
+    return lambda frame: callable_at(frame)(*[arg(frame) for arg in arg_codes])
+
+def compile_tail_call(callable_at, arg_codes):
+    """
+    Calls in tail position hand Functions back to the trampoline in
+    Function.__call__ as a TailCall, so tail recursion runs in constant
+    Python stack space.  Builtins are still called directly.
+    """
+    if len(arg_codes) == 1:
+        arg0, = arg_codes
+        def tail_call(frame):
+            func = callable_at(frame)
+            if isinstance(func, Function):
+                return TailCall(func, (arg0(frame),))
+            return func(arg0(frame))
+        return tail_call
+
+    if len(arg_codes) == 2:
+        arg0, arg1 = arg_codes
+        def tail_call(frame):
+            func = callable_at(frame)
+            if isinstance(func, Function):
+                return TailCall(func, (arg0(frame), arg1(frame)))
+            return func(arg0(frame), arg1(frame))
+        return tail_call
+
+    def tail_call(frame):
+        func = callable_at(frame)
+        args = [arg(frame) for arg in arg_codes]
+        if isinstance(func, Function):
+            return TailCall(func, args)
+        return func(*args)
+    return tail_call
+
+def compile_expr(tree, scope=None, tail=False):
+    """
+    Analyze a parsed expression once and return a closure that evaluates it
+    in a given frame.  Special forms are resolved here rather than on every
+    evaluation; malformed forms compile to closures that raise when run.
+    scope describes the frames the closure will run in (None for a plain
+    top-level Frame).  With tail=True, the expression is the last thing its
+    Function does and calls in tail position may return a TailCall instead
+    of a value.
+    """
     if isBool(tree):
-        return booleans[tree]
-    
+        value = booleans[tree]
+        return lambda frame: value
+
     if isEmptyList(tree):
-        return Pair.EMPTY_LIST
-        
+        return lambda frame: Pair.EMPTY_LIST
+
     if isStr(tree):
-        return get(tree, frame)
-        
+        return compile_symbol(tree, scope)
+
+    if not isExpression(tree):
+        return lambda frame: tree
+
     first_elem = tree[0]
-    func = evaluate(first_elem, frame)
-    if not callable(func):
-        raise SchemeEvaluationError
-    
-    if first_elem == "define":
-        if not isExpression(tree[1]):
-            name = tree[1]
-            value = evaluate(tree[2], frame)
-        else: 
-            name = tree[1][0]
-            value = create_function(tree[1][1:], tree[2], frame)
-        return create_variable(name, value, frame)
+    if isStr(first_elem) and first_elem in special_forms:
+        return special_forms[first_elem](tree, scope, tail)
+    return compile_call(tree, scope, tail)
 
-    if first_elem == "lambda":
-        return create_function(tree[1], tree[2], frame)
-    
-    if first_elem == "if":
-        return evaluate_conditional(tree[1], tree[2], tree[3], frame)
-    
-    if first_elem == "and" or first_elem == "or":
-        return comparison_builtins[first_elem]([tree[i] for i in range(1, len(tree))], frame)
+def evaluate(tree, frame=None, budget=None):
+    if frame == None:
+        frame = make_initial_frame()
+    if budget is not None:
+        with budget:
+            return compile_expr(tree)(frame)
+    return compile_expr(tree)(frame)
 
-    if first_elem == "del" or first_elem == "let" or first_elem == "set!":
-        return variable_builtins[first_elem](*tree[1:], frame)
+#############################
+# Constant Folding #
+#############################
 
-    args = []
-    for i in range(1, len(tree)):
-        args.append(evaluate(tree[i], frame))
+foldable_builtins = scheme_builtins | {
+    name: comparison_builtins[name] for name in ("equal?", ">", ">=", "<", "<=", "not")
+}
 
-    if first_elem == "begin":
-        return evaluate(args[-1])
-    return func(*tuple(args))
+def isConstant(tree):
+    return isBool(tree) or isNum(tree)
+
+def constant_value(tree):
+    return booleans[tree] if isBool(tree) else tree
+
+def bound_names(tree):
+    """
+    Every name tree binds or changes anywhere: with define, define-memo,
+    set!, del, or as a lambda or let parameter.
+    """
+    names = set()
+    stack = [tree]
+    while stack:
+        tree = stack.pop()
+        if not isExpression(tree) or not tree:
+            continue
+        first_elem = tree[0] if isStr(tree[0]) else None
+        if first_elem in {"define", "define-memo", "lambda", "set!", "del"} and len(tree) > 1:
+            target = tree[1]
+            names.update(name for name in (target if isExpression(target) else [target])
+                         if isStr(name))
+        elif first_elem == "let" and len(tree) > 1 and isExpression(tree[1]):
+            names.update(var_pair[0] for var_pair in tree[1]
+                         if isExpression(var_pair) and var_pair and isStr(var_pair[0]))
+        stack.extend(tree)
+    return names
+
+def fold_constants(tree, frame=None, rebound=None):
+    """
+    Rewrite tree with builtin arithmetic and comparisons on literal
+    arguments computed ahead of time, and if/and/or branches that can
+    never run removed.  Returns (new tree, number of nodes folded); tree
+    itself isn't changed.
+
+    A call is only folded if its builtin is what the name means in frame
+    and the name isn't in rebound (by default, bound_names(tree)).  Code
+    evaluated later that redefines a builtin doesn't unfold anything, so
+    fold everything that might rebind a name together (see fold_program).
+    Calls that would raise are left alone to raise when they run.
+    """
+    if frame is None:
+        frame = GLOBAL_FRAME
+    if rebound is None:
+        rebound = bound_names(tree)
+    folded = 0
+
+    def is_foldable(name):
+        if not isStr(name) or name not in foldable_builtins or name in rebound:
+            return False
+        try:
+            return lookup_chain(name, frame) is foldable_builtins[name]
+        except SchemeNameError:
+            return False
 
+    def fold(tree):
+        nonlocal folded
+        if not isExpression(tree) or not tree:
+            return tree
+        first_elem = tree[0] if isStr(tree[0]) else None
+
+        if first_elem == "del":
+            return tree
+        if first_elem in {"define", "define-memo", "lambda", "set!"}:
+            return list(tree[:2]) + [fold(sub) for sub in tree[2:]]
+        if first_elem == "let":
+            if len(tree) != 3 or not isExpression(tree[1]):
+                return tree
+            bindings = [
+                [var_pair[0], fold(var_pair[1])]
+                if isExpression(var_pair) and len(var_pair) == 2 else var_pair
+                for var_pair in tree[1]
+            ]
+            return ["let", bindings, fold(tree[2])]
+
+        tree = [fold(sub) for sub in tree]
+        args = tree[1:]
+
+        if first_elem == "if":
+            if len(tree) < 4 or not isConstant(tree[1]):
+                return tree
+            folded += 1
+            return tree[2] if constant_value(tree[1]) else tree[3]
+
+        if first_elem in {"and", "or"}:
+            crit_bool = first_elem == "or"
+            kept = []
+            for arg in args:
+                if not isConstant(arg):
+                    kept.append(arg)
+                elif constant_value(arg) == crit_bool:
+                    # nothing after this runs
+                    kept.append(arg)
+                    break
+            if kept == args:
+                return tree
+            folded += 1
+            if all(isConstant(arg) for arg in kept):
+                return booleans_rev[crit_bool if kept else not crit_bool]
+            return [first_elem] + kept
+
+        # tree[0] rather than first_elem: ((if #t + -) 1 2) folds too
+        if not is_foldable(tree[0]) or not all(isConstant(arg) for arg in args):
+            return tree
+        try:
+            value = foldable_builtins[tree[0]](*[constant_value(arg) for arg in args])
+        except Exception:
+            # e.g. (/ 1 0): leave it to raise when it runs
+            return tree
+        if isinstance(value, bool):
+            folded += 1
+            return booleans_rev[value]
+        if not isNum(value):
+            # e.g. floor/ makes a list, which would be shared by every run
+            return tree
+        folded += 1
+        return value
+
+    return fold(tree), folded
+
+def fold_program(trees, frame=None, rebound=None):
+    """
+    Fold a list of top-level expressions that run one after another in
+    frame, skipping every name any of them rebinds (plus any in rebound,
+    for names bound by code that runs along with them).  Returns (new
+    trees, number of nodes folded).
+    """
+    rebound = set(rebound or ()).union(*[bound_names(tree) for tree in trees])
+    new_trees, total = [], 0
+    for tree in trees:
+        tree, folded = fold_constants(tree, frame, rebound)
+        new_trees.append(tree)
+        total += folded
+    return new_trees, total
+
+#############################
+# Profiling #
+#############################
+
+class Profiler:
+    """
+    Call counts, cumulative time and self time for every named Function
+    (named at its define) and builtin called while the profiler is running.
+    Nothing here is installed until start_profiling, so an unprofiled run
+    pays nothing for it.
+    """
+    def __init__(self):
+        self.stats = {}  # name -> [calls, cumulative time, self time]
+        self.stack = []  # [name, stack node, start time, time in callees]
+        # every distinct call stack is a node (parent node, name) -> id, so
+        # entering a call doesn't copy the whole stack
+        self.nodes = {}
+        self.node_time = {}
+        self.running = {}  # name -> calls to it on the stack
+        self.builtins = {}  # unwrapped builtins, put back by stop_profiling
+
+    def enter(self, name):
+        parent = self.stack[-1][1] if self.stack else None
+        node = self.nodes.setdefault((parent, name), len(self.nodes))
+        self.running[name] = self.running.get(name, 0) + 1
+        self.stack.append([name, node, time.perf_counter(), 0.0])
+
+    def exit(self):
+        name, node, start, callees = self.stack.pop()
+        elapsed = time.perf_counter() - start
+        if self.stack:
+            self.stack[-1][3] += elapsed
+        stats = self.stats.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[2] += elapsed - callees
+        self.node_time[node] = self.node_time.get(node, 0.0) + elapsed - callees
+        self.running[name] -= 1
+        # a recursive call's time is already part of the outermost call's
+        if not self.running[name]:
+            stats[1] += elapsed
+
+    def report(self, file=None, limit=None):
+        """
+        Print one line per name, most self time first.
+        """
+        rows = sorted(self.stats.items(), key=lambda row: row[1][2], reverse=True)
+        print(f"{'calls':>10} {'cumulative ms':>14} {'self ms':>10}  name", file=file)
+        for name, (calls, cumulative, own) in rows[:limit]:
+            print(f"{calls:>10} {cumulative * 1000:>14.3f} {own * 1000:>10.3f}  {name}", file=file)
+
+    def collapsed_stacks(self):
+        """
+        {"outer;...;inner": self time in microseconds}, the format read by
+        flamegraph.pl and speedscope.
+        """
+        names = {node: key for key, node in self.nodes.items()}
+        stacks = {}
+        for node, seconds in self.node_time.items():
+            path = []
+            while node is not None:
+                node, name = names[node]
+                path.append(name)
+            stack = ";".join(reversed(path))
+            stacks[stack] = stacks.get(stack, 0) + round(seconds * 1_000_000)
+        return stacks
+
+    def write_collapsed(self, filename):
+        with open(filename, "w") as f:
+            for stack, micros in sorted(self.collapsed_stacks().items()):
+                f.write(f"{stack} {micros}\n")
+
+PROFILER = None
+
+unprofiled_call = Function.__call__
+
+def profiled_call(self, *args):
+    """
+    Function.__call__ while profiling.  Each trip around the trampoline is
+    its own call, so a tail call replaces its caller on the profiled stack.
+    """
+    profiler = PROFILER
+    func = self
+    budget = ACTIVE_BUDGETS and current_budget()
+    while True:
+        if budget:
+            try:
+                next(budget.step_ticks)
+            except StopIteration:
+                budget.over(steps=1)
+        frame = func.new_frame(args)
+        profiler.enter(func.name or "lambda")
+        try:
+            result = func.code(frame)
+        finally:
+            profiler.exit()
+        if func.pool is not None:
+            func.free_frame(frame)
+        if type(result) is not TailCall:
+            return result
+        func, args = result.func, result.args
+
+def profiled_builtin(name, builtin):
+    def call(*args):
+        PROFILER.enter(name)
+        try:
+            return builtin(*args)
+        finally:
+            PROFILER.exit()
+    return call
+
+def start_profiling():
+    """
+    Start recording calls and return the Profiler they are recorded in.
+    """
+    global PROFILER
+    if PROFILER is None:
+        PROFILER = Profiler()
+        Function.__call__ = profiled_call
+        PROFILER.builtins.update(
+            (name, value) for name, value in GLOBAL_FRAME.namespace.items()
+            if callable(value) and name not in special_forms
+        )
+        for name, builtin in PROFILER.builtins.items():
+            create_variable(name, profiled_builtin(name, builtin), GLOBAL_FRAME)
+    return PROFILER
+
+def stop_profiling():
+    """
+    Stop recording calls and return the Profiler (None if none was running).
+    """
+    global PROFILER
+    profiler = PROFILER
+    if profiler is not None:
+        Function.__call__ = unprofiled_call
+        for name, builtin in profiler.builtins.items():
+            create_variable(name, builtin, GLOBAL_FRAME)
+        PROFILER = None
+    return profiler
+
+def finish_profiling(output=None):
+    profiler = stop_profiling()
+    if profiler is None:
+        return
+    if output is None:
+        profiler.report(sys.stderr)
+    else:
+        profiler.write_collapsed(output)
+
+
+#############################
+# Budgets #
+#############################
+
+# the Budget in use on each thread (see Budget), kept in a context variable,
+# which is quicker to read than a threading.local; ACTIVE_BUDGETS counts
+# them over all threads, so while it is 0, calls and new pairs don't need
+# to look one up
+BUDGET = contextvars.ContextVar("budget", default=None)
+ACTIVE_BUDGETS = 0
+BUDGETS_LOCK = threading.Lock()
+
+# the Budget limiting evaluation on this thread, or None
+current_budget = BUDGET.get
+
+# a limit nothing reaches (as an int, for range)
+NO_LIMIT = sys.maxsize
+
+# the default limit on the size of an integer * or expt can build: one
+# multiplication can't be interrupted, and at this size it takes a tenth
+# of a second or so
+MAX_INT_BITS = 1 << 20
+
+class Watchdog:
+    """
+    A daemon thread that expires Budgets once their time is up, shared by
+    all of them, since starting a thread for each one would cost more than
+    a short evaluation.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        # a heap of [deadline, number, budget]; budget is None once cancelled
+        self.entries = []
+        self.count = 0
+        self.thread = None
+
+    def watch(self, budget, seconds):
+        """
+        Expire budget after seconds, unless the returned entry is cancelled.
+        """
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="budget watchdog", daemon=True)
+                self.thread.start()
+            self.count += 1
+            entry = [time.monotonic() + seconds, self.count, budget]
+            heapq.heappush(self.entries, entry)
+            if self.entries[0] is entry:
+                self.condition.notify()
+            return entry
+
+    def cancel(self, entry):
+        # under the lock, so once this returns the budget can't be expired
+        with self.condition:
+            entry[2] = None
+            while self.entries and self.entries[0][2] is None:
+                heapq.heappop(self.entries)
+
+    def run(self):
+        with self.condition:
+            while True:
+                while self.entries and self.entries[0][2] is None:
+                    heapq.heappop(self.entries)
+                if not self.entries:
+                    self.condition.wait()
+                    continue
+                delay = self.entries[0][0] - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.entries)[2].expire()
+
+WATCHDOG = Watchdog()
+
+def reset_watchdog():
+    # a forked child has none of its parent's threads
+    global WATCHDOG
+    WATCHDOG = Watchdog()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_watchdog)
+
+class Budget:
+    """
+    Limits for sandboxed evaluation: the number of steps (Function calls,
+    counting each tail call), the number of Pairs created by cons and the
+    builtins that build lists (a vector slot counts as a Pair), the bits in
+    an integer made by * or expt, and
+    wall-clock seconds.  None means no limit, though integers are held to
+    MAX_INT_BITS unless max_int_bits says otherwise.  Limits apply inside a
+    with block, which starts the counts over; going past one raises
+    SchemeBudgetError.  A budget only limits the thread that entered it,
+    so sessions on other threads run unaffected.
+
+    The timeout is kept by the Watchdog, which makes the next step or
+    Pair fail once time is up, so counting stays the only work per step.
+    Builtins that build or walk long lists check the limits as they go
+    (see budget_reserve and budget_elems).
+    """
+    def __init__(self, max_steps=None, max_pairs=None, timeout=None, max_int_bits=MAX_INT_BITS):
+        self.max_steps = max_steps
+        self.max_pairs = max_pairs
+        self.timeout = timeout
+        self.max_int_bits = max_int_bits
+        self.counts = (0, 0)
+        self.expired = False
+        self.watch_entry = None
+        self.in_use = False
+        self.token = None
+
+    def __enter__(self):
+        global ACTIVE_BUDGETS
+        if self.in_use:
+            raise RuntimeError("this Budget is already in use")
+        self.in_use = True
+        self.expired = False
+        # each step and Pair takes the next tick from these, so the only
+        # work per step is a next() that raises StopIteration once the
+        # limit is reached (or the Watchdog has used them up)
+        self.step_limit = NO_LIMIT if self.max_steps is None else self.max_steps
+        self.pair_limit = NO_LIMIT if self.max_pairs is None else self.max_pairs
+        self.step_ticks = iter(range(self.step_limit))
+        self.pair_ticks = iter(range(self.pair_limit))
+        self.counts = None
+        if self.timeout is not None:
+            self.watch_entry = WATCHDOG.watch(self, self.timeout)
+        self.token = BUDGET.set(self)
+        with BUDGETS_LOCK:
+            ACTIVE_BUDGETS += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        global ACTIVE_BUDGETS
+        if self.watch_entry is not None:
+            WATCHDOG.cancel(self.watch_entry)
+            self.watch_entry = None
+        self.counts = (self.steps, self.pairs)
+        BUDGET.reset(self.token)
+        self.token = None
+        self.in_use = False
+        with BUDGETS_LOCK:
+            ACTIVE_BUDGETS -= 1
+
+    @property
+    def steps(self):
+        if self.counts is not None:
+            return self.counts[0]
+        return self.step_limit - operator.length_hint(self.step_ticks)
+
+    @property
+    def pairs(self):
+        if self.counts is not None:
+            return self.counts[1]
+        return self.pair_limit - operator.length_hint(self.pair_ticks)
+
+    def expire(self):
+        # called by the Watchdog's thread
+        self.counts = (self.steps, self.pairs)
+        self.expired = True
+        self.step_ticks = self.pair_ticks = iter(())
+
+    def over(self, steps=0, pairs=0):
+        """
+        Raise for the limit that was reached, counting the step or Pair
+        that found no tick left.
+        """
+        if self.counts is None:
+            self.counts = (self.steps + steps, self.pairs + pairs)
+        if self.expired:
+            raise SchemeBudgetError(f"more than {self.timeout} seconds")
+        if steps:
+            raise SchemeBudgetError(f"more than {self.max_steps} steps")
+        raise SchemeBudgetError(f"more than {self.max_pairs} pairs")
+
+    def reserve(self, count):
+        """
+        Raises now if count more Pairs would go past the limit.
+        """
+        if self.expired or operator.length_hint(self.pair_ticks) < count:
+            self.over()
+
+    def charge(self, count):
+        self.reserve(count)
+        used = self.pair_limit - operator.length_hint(self.pair_ticks)
+        self.pair_ticks = iter(range(used + count, self.pair_limit))
+        if self.expired:  # and the Watchdog's empty ticks were just replaced
+            self.over()
+
+def budget_reserve(count):
+    """
+    For builtins about to create count Pairs: fails before doing the work if
+    the active Budget (if any) can't afford them.
+    """
+    budget = ACTIVE_BUDGETS and current_budget()
+    if budget:
+        budget.reserve(count)
+
+def budget_charge(count):
+    """
+    Counts count new Pairs (or vector slots, which count as Pairs) against
+    the active Budget, failing first if it can't afford them.
+    """
+    budget = ACTIVE_BUDGETS and current_budget()
+    if budget:
+        budget.charge(int(count))
+
+def budget_int_bits(bits):
+    """
+    For * and expt, before they build an integer of about bits bits.
+    """
+    budget = ACTIVE_BUDGETS and current_budget()
+    if budget and budget.max_int_bits is not None and bits > budget.max_int_bits:
+        raise SchemeBudgetError(f"an integer of more than {budget.max_int_bits} bits")
+
+def budget_elems(elems):
+    """
+    An iterator over elems that stops once the active Budget's time is up,
+    for builtins whose loops make no calls or Pairs that would notice.
+    """
+    budget = ACTIVE_BUDGETS and current_budget()
+    if not budget:
+        return elems
+    return itertools.chain.from_iterable(checked_chunks(iter(elems), budget))
+
+def checked_chunks(elems, budget, size=1024):
+    while True:
+        if budget.expired:
+            budget.over()
+        chunk = list(itertools.islice(elems, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+#############################
+# Interpreters #
+#############################
+
+class Interpreter:
+    """
+    A Scheme session with a global frame of its own, over a frozen base
+    frame (BASE_FRAME, or a prelude from make_base) that any number of
+    Interpreters share.  Definitions land in the session's own frame, and
+    set! of a base binding rebinds it for this session only (copy on
+    write), so sessions
+    can't see or change each other's variables and can run on different
+    threads.  Calls on one Interpreter are serialized by its lock.
+
+    The rebound values are kept in the frame's overlay, which maps each
+    frozen frame to the session's own copy of the bindings it changed.
+    Functions defined in the prelude see the overlay of the session calling
+    them (through SESSION), so one that set!s a prelude global (a counter,
+    a cache) changes it for that session only, as if the prelude had been
+    loaded into it.  Values reachable from the base (lists, vectors, hash
+    tables) are shared, not copied, and the profiler is still process-wide
+    (Budgets are per thread).
+    """
+    def __init__(self, base=None):
+        base = BASE_FRAME if base is None else base
+        self.frame = Frame(base)
+        self.frame.copy_on_write = True
+        # starting from whatever the prelude's own code set! while loading
+        self.frame.overlay = {}
+        if base.overlay:
+            self.frame.overlay = {frame: dict(bindings) for frame, bindings in base.overlay.items()}
+        self.lock = threading.Lock()
+
+    def call(self, func, *args, **kwargs):
+        """
+        func(*args, **kwargs), holding the lock, as this session.
+        """
+        with self.lock:
+            token = SESSION.set(self.frame)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                SESSION.reset(token)
+
+    def evaluate(self, tree):
+        return self.call(evaluate, tree, self.frame)
+
+    def run(self, source):
+        """
+        Evaluate each top-level expression in the string source, returning
+        the value of the last one.
+        """
+        def run_all():
+            result = None
+            for expr in parse_stream(tokenize(source)):
+                result = evaluate(expr, self.frame)
+            return result
+        return self.call(run_all)
+
+    def evaluate_file(self, filename, use_cache=True):
+        return self.call(evaluate_file, filename, self.frame, use_cache=use_cache)
+
+def make_base(*filenames, base=None):
+    """
+    A frozen frame holding the definitions in filenames (evaluated over
+    base, by default BASE_FRAME), for Interpreters to start from.  Whatever
+    the files set! in base stays in the frame's overlay, which each
+    Interpreter copies (see Interpreter).
+    """
+    interpreter = Interpreter(base)
+    for filename in filenames:
+        interpreter.evaluate_file(filename)
+    return freeze(interpreter.frame)
 
 
 if __name__ == "__main__":
-    import os
+    import atexit
+    import argparse
+    import contextlib
+    parser = argparse.ArgumentParser(description="Evaluate Scheme files, then start a REPL.")
+    parser.add_argument("files", nargs="*")
+    parser.add_argument("--profile", action="store_true",
+                        help="print calls and time per function to stderr at exit")
+    parser.add_argument("--profile-output", metavar="FILE",
+                        help="with --profile, write collapsed stacks for a flamegraph to FILE instead")
+    parser.add_argument("--fold", action="store_true",
+                        help="fold constant expressions in the files before running them "
+                             "(skipping names any file rebinds; rebinding a builtin at "
+                             "the REPL afterwards doesn't unfold them)")
+    parser.add_argument("--max-steps", type=int, metavar="N",
+                        help="stop each file or REPL input after N function calls")
+    parser.add_argument("--max-pairs", type=int, metavar="N",
+                        help="stop each file or REPL input after it creates N pairs")
+    parser.add_argument("--timeout", type=float, metavar="SECONDS",
+                        help="stop each file or REPL input after SECONDS")
+    parser.add_argument("--image", metavar="FILE",
+                        help="start from the frame saved in FILE instead of an empty one")
+    parser.add_argument("--save-image", metavar="FILE",
+                        help="save the frame to FILE after running the files, then exit")
+    args = parser.parse_args()
+    budget = None
+    if args.max_steps is not None or args.max_pairs is not None or args.timeout is not None:
+        budget = Budget(args.max_steps, args.max_pairs, args.timeout)
+    if args.profile:
+        start_profiling()
+        atexit.register(finish_profiling, args.profile_output)
+
     sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
-    initial_frame = make_initial_frame()
-    for filename in sys.argv:
-        if filename != "lab.py":
-            evaluate_file(filename, initial_frame)
+    initial_frame = load_image(args.image) if args.image else make_initial_frame()
+    if args.fold:
+        # a file can rebind a name that earlier ones use, so nothing is
+        # folded until every file has been looked at
+        programs = [parse_file(filename) for filename in args.files]
+        rebound = set().union(*[bound_names(tree) for trees in programs for tree in trees])
+    for i, filename in enumerate(args.files):
+        if not args.fold:
+            evaluate_file(filename, initial_frame, use_cache=True, budget=budget)
+            continue
+        expressions, folded = fold_program(programs[i], initial_frame, rebound)
+        print(f"{filename}: folded {folded} nodes", file=sys.stderr)
+        with budget or contextlib.nullcontext():
+            for expression in expressions:
+                evaluate(expression, initial_frame)
+    if args.save_image:
+        save_image(initial_frame, args.save_image)
+        sys.exit()
     import schemerepl
-    schemerepl.SchemeREPL(sys.modules[__name__], use_frames=True, verbose=True, repl_frame=initial_frame).cmdloop()
+    schemerepl.SchemeREPL(
+        sys.modules[__name__], use_frames=True, verbose=True, repl_frame=initial_frame, budget=budget
+    ).cmdloop()
@@ -41,11 +41,13 @@ class SchemeREPL(Cmd):
     history_file = os.path.join(os.path.expanduser("~"), ".6101_scheme_history")
 
     if supports_color():
-        prompt = "\001\033[96m\002in>\001\033[0m\002 "
+        prompt = first_prompt = "\001\033[96m\002in>\001\033[0m\002 "
+        continue_prompt = "\001\033[96m\002...\001\033[0m\002 "
         value_msg = "  out> \033[92m\033[1m%s\033[0m"
         error_msg = "  \033[91mEXCEPTION!! %s\033[0m"
     else:
-        prompt = "in> "
+        prompt = first_prompt = "in> "
+        continue_prompt = "... "
         value_msg = "  out> %s"
         error_msg = "  EXCEPTION!! %s"
 
@@ -54,11 +56,20 @@ class SchemeREPL(Cmd):
         "define", "lambda", "if", "equal?", "<", "<=", ">", ">=", "and", "or",
         "del", "let", "set!", "+", "-", "*", "/", "#t", "#f", "not", "cons",
         "list", "cat", "cdr", "list-ref", "length", "append", "begin",
+        "vector", "make-vector", "vector?", "vector-ref", "vector-set!",
+        "vector-length", "vector->list", "list->vector",
+        "define-memo", "memoize", "memo-hits", "memo-misses", "map", "filter",
+        "reduce", "range", "pmap",
+        "floor/", "modulo", "expt", "sqrt", "exact", "inexact",
+        "make-hash", "hash?", "hash-ref", "hash-set!", "hash-has-key?", "hash-keys",
+        "hash-count",
     }
     # fmt: on
 
-    def __init__(self, lab_module, use_frames=False, verbose=False, repl_frame=None):
+    def __init__(self, lab_module, use_frames=False, verbose=False, repl_frame=None, budget=None):
         self.verbose = verbose
+        # limits (a lab.Budget) applied to each input separately
+        self.budget = budget
         self.use_frames = use_frames
         self.module = lab_module
         if use_frames:
@@ -67,8 +78,19 @@ class SchemeREPL(Cmd):
                 if repl_frame is not None
                 else self.module.make_initial_frame()
             )
+        self.reset_reader()
         Cmd.__init__(self)
 
+    def reset_reader(self):
+        """
+        Forget any partly typed expression.  Lines are read with one
+        Tokenizer and Parser, so an expression can span any number of lines
+        and each one is only tokenized once.
+        """
+        self.tokenizer = self.module.Tokenizer()
+        self.parser = self.module.Parser()
+        self.prompt = self.first_prompt
+
     def preloop(self):
         try:
             if readline and os.path.isfile(self.history_file):
@@ -89,7 +111,8 @@ class SchemeREPL(Cmd):
         return sorted(i for i in (self.keywords | bound_vars) if i.startswith(text))
 
     def onecmd(self, line):
-        if line in {"EOF", "quit", "QUIT"}:
+        reading = self.parser.depth > 0
+        if line == "EOF" or (not reading and line in {"quit", "QUIT"}):
             print()
             print("bye bye!")
             return True
@@ -97,29 +120,75 @@ class SchemeREPL(Cmd):
         elif not line.strip():
             return False
 
+        elif not reading and line.startswith(":profile"):
+            self.profile_command(line.split()[1:])
+            return False
+
         try:
-            token_list = self.module.tokenize(line)
+            token_list = self.tokenizer.feed(line + "\n")
             if self.verbose:
                 print("tokens>", token_list)
-            expression = self.module.parse(token_list)
-            if self.verbose:
-                print("expression>", expression)
-            args = [expression]
-            if self.use_frames:
-                args.append(self.repl_frame)
-            output = self.module.evaluate(*args)
-            print(self.value_msg % output)
-        except self.module.SchemeError as e:
-            if self.verbose:
-                traceback.print_tb(e.__traceback__)
-                print(self.error_msg.replace("%s", "%r") % e)
+            # each expression is evaluated as soon as its last token is read
+            for expression in self.parser.feed(token_list):
+                self.evaluate(expression)
+        except self.module.SchemeSyntaxError as e:
+            self.reset_reader()
+            self.print_error(e)
+        self.prompt = self.continue_prompt if self.parser.depth else self.first_prompt
+        return False
+
+    def evaluate(self, expression):
+        if self.verbose:
+            print("expression>", expression)
+        args = [expression]
+        if self.use_frames:
+            args.append(self.repl_frame)
+        try:
+            if self.budget is not None:
+                output = self.module.evaluate(*args, budget=self.budget)
             else:
-                print(self.error_msg % e)
+                output = self.module.evaluate(*args)
+            try:
+                text = self.value_msg % output
+            except ValueError as e:  # an int with more digits than str() allows
+                raise self.module.SchemeEvaluationError(f"result too big to print: {e}")
+            print(text)
+        except self.module.SchemeError as e:
+            self.print_error(e)
 
-        return False
+    def print_error(self, e):
+        if self.verbose:
+            traceback.print_tb(e.__traceback__)
+            print(self.error_msg.replace("%s", "%r") % e)
+        else:
+            print(self.error_msg % e)
 
     completenames = completedefault
 
+    def profile_command(self, args):
+        """
+        :profile on          start recording calls
+        :profile             print the calls recorded so far
+        :profile off [FILE]  stop, then print the report or write collapsed
+                             stacks (for a flamegraph) to FILE
+        """
+        if not hasattr(self.module, "start_profiling"):
+            print(self.error_msg % "this interpreter has no profiler")
+        elif args[:1] == ["on"]:
+            self.module.start_profiling()
+        elif args[:1] == ["off"]:
+            profiler = self.module.stop_profiling()
+            if profiler is None:
+                print(self.error_msg % "the profiler is not running")
+            elif len(args) > 1:
+                profiler.write_collapsed(args[1])
+            else:
+                profiler.report()
+        elif self.module.PROFILER is None:
+            print(self.error_msg % "the profiler is not running (:profile on)")
+        else:
+            self.module.PROFILER.report()
+
     def cmdloop(self, intro=None):
         while True:
             try:
@@ -127,3 +196,4 @@ class SchemeREPL(Cmd):
                 break
             except KeyboardInterrupt:
                 print("^C")
+                self.reset_reader()
@@ -4,15 +4,23 @@ LISP Interpreter Part 2
 """
 
 #!/usr/bin/env python3
+import io
 import os
 import lab
 import sys
 import json
+import shutil
+import pickle
 import time
 import types
+import batch
 import random
 import tempfile
+import threading
+import schemerepl
 import subprocess
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
@@ -22,6 +30,13 @@ MFR_NAMES = ("map", "filter", "reduce")
 MFR_FILE = os.path.join(TEST_DIRECTORY, "test_files", "map_filter_reduce.scm")
 
 
+def run(line, frame=None, budget=None):
+    """
+    Evaluate the one expression in the string line.
+    """
+    return lab.evaluate(lab.parse(lab.tokenize(line)), frame, budget)
+
+
 class NotImplemented:
     def __eq__(self, other):
         return False
@@ -280,7 +295,6 @@ def _test_file_msg(fname, n):
     return msg
 
 
-
 def test_oldbehaviors():
     run_test_number(0, lab.tokenize)
     run_test_number(31, lab.tokenize)
@@ -323,6 +337,7 @@ def test_make_initial_frame():
 
 # SYNTAX ERRORS
 
+
 def test_syntax_errors_1():
     run_test_number(2, lab.parse)
 
@@ -331,7 +346,6 @@ def test_syntax_errors_2():
     run_test_number(3, lambda i: lab.parse(lab.tokenize(i)), "parse(tokenize(line))")
 
 
-
 # BOOLEANS AND CONDITIONALS
 
 
@@ -386,6 +400,51 @@ def test_conditional_scoping_2():
     do_raw_continued_evaluations(40)
 
 
+# TESTS FOR NUMBERS
+
+
+def test_numeric_tower():
+    frame = lab.make_initial_frame()
+    assert lab.parse(lab.tokenize("(+ 1/3 x/y)")) == ["+", Fraction(1, 3), "x/y"]
+    for source, expected in [
+        ("(+ 1/3 1/6)", Fraction(1, 2)),
+        ("(- 10 1 2 3)", 4),
+        ("(- 5)", -5),
+        ("(* 2 3 4)", 24),
+        ("(/ 1 4)", 0.25),
+        ("(/ 12 2 3)", 2.0),
+        ("(/ (exact 1) 3)", Fraction(1, 3)),
+        ("(/ (expt 10 400) (expt 10 399))", 10.0),
+        ("(/ (expt 10 400) 10)", Fraction(10**399)),  # too big for a float
+        ("(/ 1.5 (expt 10 400))", 0.0),  # stays inexact
+        ("(/ (expt 10 400) 1/10)", Fraction(10**401)),
+        ("(modulo -7 2)", 1),
+        ("(expt 2 100)", 2**100),
+        ("(expt 1/2 3)", Fraction(1, 8)),
+        ("(expt 4 0.5)", 2.0),
+        ("(sqrt 16)", 4),
+        ("(sqrt 9/4)", Fraction(3, 2)),
+        ("(sqrt 2)", 2 ** 0.5),
+        ("(exact 0.25)", Fraction(1, 4)),
+        ("(exact 3.0)", Fraction(3)),
+        ("(inexact 1/4)", 0.25),
+    ]:
+        result = run(source, frame)
+        assert result == expected and type(result) == type(expected), source
+    assert run("(floor/ -7 2)", frame) == lab.create_list(-4, 1)
+    assert run("(floor/ 1.5 (expt 10 400))", frame) == lab.create_list(0.0, 1.5)
+    assert run("(floor/ (expt 10 400) 3)", frame) == lab.create_list(10**400 // 3, 1)
+    assert lab.parse(lab.tokenize("(1/0 -2/0)")) == ["1/0", "-2/0"]  # names, not numbers
+    assert run("(sqrt (expt 10 402))", frame) == 10**201
+    assert run("(sqrt (+ (expt 10 401) 1))", frame) == pytest.approx(10**200.5)
+
+    for bad in ["(-)", "(/)", "(/ 1 0)", "(modulo 1 0)", "(floor/ 1 0)", "(sqrt -4)",
+                "(expt 0 -1)", "(expt -8 1/3)", "(expt 2)", "(exact (/ 1.0 0.0))", "(sqrt (list 1))",
+                "(/ (expt 10 400) 0.5)", "(floor/ -1.5 (expt 10 400))"]:
+        with pytest.raises(lab.SchemeEvaluationError):
+            run(bad, frame)
+
+
 # TESTS FOR LIST BASICS
 
 
@@ -423,6 +482,101 @@ def test_list_ops():
     do_raw_continued_evaluations(47)
 
 
+def test_long_lists():
+    frame = lab.make_initial_frame()
+    for line in [
+        "(define (build n acc) (if (equal? n 0) acc (build (- n 1) (cons n acc))))",
+        "(define big (build 100000 (list)))",
+    ]:
+        run(line, frame)
+    assert run("(length big)", frame) == 100000
+    assert run("(list? big)", frame) is True
+    assert run("(list-ref big 99999)", frame) == 100000
+    assert run("(length (append big big))", frame) == 200000
+    assert run("(equal? big (append big (list)))", frame) is True
+    assert run("(length (append (list (list)) (list 1)))", frame) == 2
+
+
+def test_list_length_cache_invalidation():
+    frame = lab.make_initial_frame()
+    run("(define x (list 1 2 3 4))", frame)
+    run("(define y (cons 0 x))", frame)
+    assert run("(length y)", frame) == 5
+    try:
+        lab.evaluate("x", frame).cdr.set_cdr(7)
+        assert run("(list? y)", frame) is False
+        assert run("(list? (cdr x))", frame) is False
+        lab.evaluate("x", frame).cdr.set_cdr(lab.create_list(5))
+        assert run("(length y)", frame) == 4
+    finally:
+        lab.Pair.cached_lengths = True
+
+
+# TESTS FOR VECTORS AND HASH TABLES
+
+
+def test_vectors():
+    frame = lab.make_initial_frame()
+    run("(define v (make-vector 3 7))", frame)
+    assert run("(vector-length v)", frame) == 3
+    assert run("(vector-set! v 1 (list 1 2))", frame) == lab.create_list(1, 2)
+    assert run("(vector-ref v 1)", frame) == lab.create_list(1, 2)
+    assert run("(vector->list v)", frame) == lab.create_list(7, lab.create_list(1, 2), 7)
+    assert run("(equal? v (list->vector (list 7 (list 1 2) 7)))", frame) is True
+    assert run("(equal? v (vector 7 7 7))", frame) is False
+    assert run("(vector? v)", frame) is True and run("(vector? (list 1))", frame) is False
+    assert str(run("(vector 1 (vector 2) 3)", frame)) == "#(1 #(2) 3)"
+    for bad in [
+        "(vector-ref v 3)",
+        "(vector-ref v -1)",
+        "(vector-ref v 1.5)",
+        "(vector-ref (list 1 2) 0)",
+        "(vector-set! v 0)",
+        "(make-vector -1)",
+        "(vector-ref v (* 1e308 10))",
+        "(vector-ref v (- (* 1e308 10) (* 1e308 10)))",
+        "(make-vector (* 1e308 10))",
+        "(make-vector (- (* 1e308 10) (* 1e308 10)))",
+        "(list->vector (cons 1 2))",
+        "(vector-length 5)",
+    ]:
+        with pytest.raises(lab.SchemeEvaluationError):
+            run(bad, frame)
+
+
+def test_hash_tables():
+    frame = lab.make_initial_frame()
+    run("(define h (make-hash))", frame)
+    assert run("(hash-count h)", frame) == 0
+    assert run("(hash-set! h 1 10)", frame) == 10
+    run("(hash-set! h #t 2)", frame)
+    run("(hash-set! h (list 1 2) 3)", frame)
+    run("(hash-set! h (cons 1 2) 4)", frame)
+    run("(hash-set! h (list 1 2) 5)", frame)
+    assert run("(hash-count h)", frame) == 4
+    assert run("(hash-ref h 1)", frame) == 10 and run("(hash-ref h #t)", frame) == 2
+    assert run("(hash-ref h (list 1 2))", frame) == 5 and run("(hash-ref h (cons 1 2))", frame) == 4
+    assert run("(hash-has-key? h (list 1 2))", frame) is True
+    assert run("(hash-has-key? h (list 1))", frame) is False
+    assert run("(hash-ref h 7 0)", frame) == 0
+    assert run("(length (hash-keys h))", frame) == 4
+    assert run("(hash? h)", frame) is True and run("(hash? (list))", frame) is False
+    run("(define g (make-hash (list (cons 1.5 1) (cons (list) 2))))", frame)
+    assert run("(hash-ref g (list))", frame) == 2 and run("(hash-ref g 1.5)", frame) == 1
+    lab.hash_set(run("g", frame), lab.symbol("x"), 3)
+    assert lab.hash_ref(run("g", frame), lab.symbol("x")) == 3
+    for bad in [
+        "(hash-ref h 7)",
+        "(hash-ref (list) 1)",
+        "(hash-set! h (vector 1) 1)",
+        "(hash-set! h (lambda (x) x) 1)",
+        "(hash-count)",
+        "(make-hash (list 1 2))",
+    ]:
+        with pytest.raises(lab.SchemeEvaluationError):
+            run(bad, frame)
+
+
 # TESTS FOR READING CODE FROM FILES
 
 
@@ -561,18 +715,208 @@ def test_file_repl():
     try_clear_tempfile()
 
 
+def test_repl_multiline():
+    repl = schemerepl.SchemeREPL(lab, use_frames=True)
+    output = io.StringIO()
+    sys.stdout, stdout = output, sys.stdout
+    try:
+        for line in ["(define (double x)", "  ; quit", "  (* 2", "  x))",
+                     "(double 4) (double 5)", ")", "(+ 1", "2)", "(expt 10 5000)"]:
+            assert not repl.onecmd(line)
+        assert repl.prompt == repl.first_prompt
+        repl.onecmd("(double")
+        assert repl.prompt == repl.continue_prompt
+        assert not repl.onecmd("quit")  # a symbol, mid-expression
+        assert repl.onecmd("EOF")
+    finally:
+        sys.stdout = stdout
+    lines = output.getvalue().splitlines()
+    assert [line for line in lines if "out>" in line][1:] == ["  out> 8", "  out> 10", "  out> 3"]
+    assert sum("EXCEPTION" in line for line in lines) == 2
+    assert any("too big to print" in line for line in lines)
+
+
+def test_tokenize_stream_chunks():
+    source = "(define (f x) ; comment (with parens)\n  (+ x 10.5))\n(f 2)"
+    expected = lab.tokenize(source)
+    for chunk_size in (1, 2, 3, 7, 64):
+        tokens = list(lab.tokenize_stream(io.StringIO(source), chunk_size))
+        assert tokens == expected
+    exprs = list(lab.parse_stream(lab.tokenize_stream(io.StringIO(source), 5)))
+    assert exprs == [["define", ["f", "x"], ["+", "x", 10.5]], ["f", 2]]
+    assert lab.evaluate_stream(io.StringIO(source)) == 12.5
+    with pytest.raises(lab.SchemeSyntaxError):
+        list(lab.parse_stream(lab.tokenize_stream(io.StringIO("(f 2"))))
+
+
+def test_compact_trees():
+    tree = lab.parse(lab.tokenize("(define (f x) (if (< x 0) (- x) (if (< x 0) (- x) x)))"))
+    assert tree[0] is lab.symbol("define")
+    assert tree[0] == "define" and isinstance(tree[0], lab.Symbol)
+
+    compacted = lab.compact(tree)
+    assert compacted == ("define", ("f", "x"), ("if", ("<", "x", 0), ("-", "x"), ("if", ("<", "x", 0), ("-", "x"), "x")))
+    inner = compacted[2][3]
+    assert compacted[2][1] is inner[1] and compacted[2][2] is inner[2]
+    assert lab.compact(["+", 1, 1.0]) == ("+", 1, 1.0)
+    nodes = {}
+    assert lab.compact(["-", "x"], nodes) is lab.compact(("-", "x"), nodes)
+    assert lab.compact(["-", 1], nodes) is not lab.compact(["-", 1.0], nodes)
+    assert str(lab.compact(["-", 0.0], nodes)[1]) == "0.0"
+    assert str(lab.compact(["-", -0.0], nodes)[1]) == "-0.0"
+    assert str(lab.evaluate_stream(io.StringIO("(* 1 0.0) (* 1 -0.0)"))) == "-0.0"
+
+    loaded = pickle.loads(pickle.dumps(compacted))
+    assert loaded == compacted and loaded[0] is lab.symbol("define")
+
+    frame = lab.make_initial_frame()
+    lab.evaluate(compacted, frame)
+    for source, expected in [("(f -3)", 3), ("(f 4)", 4), ("(let ((y ())) (list? y))", True)]:
+        assert lab.evaluate(lab.compact(lab.parse(lab.tokenize(source))), frame) == expected
+
+
+def test_file_parse_cache():
+    directory = tempfile.mkdtemp()
+    try:
+        script = os.path.join(directory, "script.scm")
+        with open(script, "w") as f:
+            f.write("(define x 2)\n(* x 21)\n")
+        assert lab.evaluate_file(script, use_cache=True) == 42
+        assert os.path.exists(lab.cache_path(script))
+        assert lab.load_cached_expressions(script) == [("define", "x", 2), ("*", "x", 21)]
+        assert lab.evaluate_file(script, use_cache=True) == 42
+
+        os.utime(script)
+        assert lab.load_cached_expressions(script) is not None
+        with open(script, "w") as f:
+            f.write("(define x 2)\n(* x 50)\n")
+        os.utime(script, ns=(0, 0))
+        assert lab.load_cached_expressions(script) is None
+        assert lab.evaluate_file(script, use_cache=True) == 100
+
+        # an unreadable entry is a miss, and no temporary files are left over
+        with open(lab.cache_path(script), "rb") as f:
+            entry = pickle.load(f)
+        # entries from a build that parsed differently are misses too
+        entry["version"] -= 1
+        stale = pickle.dumps(entry)
+        for junk in [b"\x80\x05junk", b"cno_such_module\nThing\n.", stale]:
+            with open(lab.cache_path(script), "wb") as f:
+                f.write(junk)
+            assert lab.load_cached_expressions(script) is None
+        assert lab.evaluate_file(script, use_cache=True) == 100
+        assert lab.load_cached_expressions(script) is not None
+        assert os.listdir(os.path.dirname(lab.cache_path(script))) == ["script.scm.pickle"]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_pickle_values():
+    frame = lab.make_initial_frame()
+    run("(define (f n) (lambda (x) (cons n (* x x))))", frame)
+    run("(define g (f 3))", frame)
+    g = lab.load_value(lab.dump_value(lab.evaluate("g", frame)))
+    assert g.frame.parent.parent is lab.GLOBAL_FRAME
+    assert g(4) == lab.Pair(3, 16)
+    assert lab.load_value(lab.dump_value(lab.GLOBAL_FRAME.namespace["+"])) is lab.scheme_builtins["+"]
+    long_list = lab.create_list(*range(100_000))
+    assert lab.load_value(lab.dump_value(long_list)) == long_list
+
+
+def test_images():
+    frame = lab.make_initial_frame()
+    for line in [
+        "(define (make-counter) (begin (define n 0) (lambda () (begin (set! n (+ n 1)) n))))",
+        "(define c (make-counter))",
+        "(c)",
+        "(define tail (list 3 4))",
+        "(define a (cons 1 tail))",
+        "(define b (cons 2 tail))",
+        "(define self (list (lambda () self) 5))",
+        "(define big (range 0 100000))",
+        "(define h (make-hash))",
+        "(hash-set! h (list 1 2) a)",
+        "(define-memo (sum l) (if (equal? l (list)) 0 (+ (car l) (sum (cdr l)))))",
+        "(sum (list 1 2 3))",
+        "(define v (vector 1 2/3 a))",
+        "(define improper (cons 1 (cons 2 3)))",
+    ]:
+        run(line, frame)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "prelude.img")
+        lab.save_image(frame, path)
+        restored = lab.load_image(path)
+        result = subprocess.run(
+            [sys.executable, "-c",
+             f"import lab; print(lab.evaluate(lab.parse(lab.tokenize('(c)')), lab.load_image({path!r})))"],
+            cwd=TEST_DIRECTORY, capture_output=True, text=True,
+        )
+        assert result.stdout == "2\n"
+        with open(path, "wb") as f:
+            f.write(b"not an image")
+        with pytest.raises(ValueError):
+            lab.load_image(path)
+    finally:
+        shutil.rmtree(directory)
+
+    assert restored.parent is lab.GLOBAL_FRAME
+    assert run("(c)", restored) == 2 and run("(c)", restored) == 3 and run("(c)", frame) == 2
+    assert run("(cdr a)", restored) is run("(cdr b)", restored) is run("tail", restored)
+    assert run("((car self))", restored) is run("self", restored)
+    assert run("(length big)", restored) == 100000 and run("(list-ref big 99999)", restored) == 99999
+    assert run("(hash-ref h (list 1 2))", restored) is run("a", restored)
+    assert run("(sum (list 1 2 3))", restored) == 6
+    assert run("(vector-ref v 2)", restored) is run("a", restored)
+    assert run("(list? improper)", restored) is False and run("(cdr (cdr improper))", restored) == 3
+
+
+def test_batch_runner():
+    directory = tempfile.mkdtemp()
+    try:
+        sources = {
+            "ok.scm": "(define x 3)\n(* x 2)\n",
+            "name_error.scm": "(undefined-function 1)\n",
+            "syntax_error.scm": "(+ 1 2))\n",
+            "no_frame_leak.scm": "x\n",  # each file starts in a fresh frame
+            # batch workers are daemonic, so pmap maps in place
+            "pmap.scm": "(length (pmap (lambda (x) (* x x)) (list 1 2 3)))\n",
+        }
+        filenames = []
+        for name, source in sources.items():
+            filenames.append(os.path.join(directory, name))
+            with open(filenames[-1], "w") as f:
+                f.write(source)
+        filenames = filenames * 3
+
+        results = list(batch.run_batch(filenames, workers=2, files_per_worker=2))
+        assert [result.filename for result in results] == filenames
+        assert [(result.value, result.error) for result in results] == [
+            ("6", None),
+            (None, "SchemeNameError"),
+            (None, "SchemeSyntaxError"),
+            (None, "SchemeNameError"),
+            ("3", None),
+        ] * 3
+        assert all(result.seconds > 0 for result in results)
+    finally:
+        shutil.rmtree(directory)
+
+
 # TESTS FOR MAP FILTER REDUCE
 
 
 def test_map_filter_reduce_defined_externally_in_scheme():
+    # map, filter and reduce are also native builtins; the Scheme definitions
+    # loaded from MFR_FILE shadow them
     initial_frame = lab.make_initial_frame()
     for name in MFR_NAMES:
-        with pytest.raises(lab.SchemeNameError):
-            lab.evaluate(name, initial_frame)
+        res = lab.evaluate(name, initial_frame)
+        assert res is lab.list_builtins[name]
     lab.evaluate_file(os.path.join(TEST_DIRECTORY, "test_files", "definitions.scm"), initial_frame)
     for name in MFR_NAMES:
-        with pytest.raises(lab.SchemeNameError):
-            lab.evaluate(name, initial_frame)
+        res = lab.evaluate(name, initial_frame)
+        assert res is lab.list_builtins[name]
     lab.evaluate_file(MFR_FILE, initial_frame)
     baseline = lab.evaluate(["lambda", ["x"], "x"])
     for name in MFR_NAMES:
@@ -625,6 +969,19 @@ def test_map_filter_reduce_1():
     do_raw_continued_evaluations(84, initial_frame)
 
 
+def test_map_filter_reduce_native():
+    for n in (78, 79, 80, 81, 82, 83, 84):
+        do_raw_continued_evaluations(n)
+    compare_outputs(*_test_file("small_test3.scm", 51))
+    assert run("(range 4)") == lab.create_list(0, 1, 2, 3)
+    assert run("(range 1 10 3)") == lab.create_list(1, 4, 7)
+    assert run("(range 3 0 -1)") == lab.create_list(3, 2, 1)
+    assert run("(range 3 0)") == lab.create_list()
+    for bad in ["(range)", "(range 1 2 0)", "(map 7 (list 1))", "(filter car 7)", "(reduce + (list 1))"]:
+        with pytest.raises(lab.SchemeEvaluationError):
+            run(bad)
+
+
 def test_file_3():
     initial_frame = lab.make_initial_frame()
     lab.evaluate_file(MFR_FILE, initial_frame)
@@ -670,6 +1027,92 @@ def test_begin_2():
     do_raw_continued_evaluations(57)
 
 
+def test_lexical_scoping():
+    do_raw_continued_evaluations(94)
+
+
+def test_lookup_caches():
+    frame = lab.make_initial_frame()
+    run("(define (f x) (+ x 1))", frame)
+    assert run("(f 1)", frame) == 2 and run("(f 1)", frame) == 2
+    run("(define + -)", frame)
+    assert run("(f 1)", frame) == 0
+    run("(set! + *)", frame)
+    assert run("(f 3)", frame) == 3
+    run("(del +)", frame)
+    assert run("(f 1)", frame) == 2
+    run("(define + -)", lab.make_initial_frame())
+    assert run("(f 1)", frame) == 2
+
+    # one compiled lookup used from two different frames
+    code = lab.compile_symbol("car")
+    frame1, frame2 = lab.make_initial_frame(), lab.make_initial_frame()
+    car = code(frame1)
+    lab.create_variable("car", 5, frame1)
+    assert code(frame1) == 5 and code(frame2) is car and code(frame1) == 5
+    lab.delete_variable("car", frame1)
+    assert code(frame1) is car
+    with pytest.raises(lab.SchemeNameError):
+        lab.compile_symbol("nope")(frame1)
+
+
+def test_frame_pools():
+    frame = lab.make_initial_frame()
+    run("(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))", frame)
+    run("(define (sum-to n) (if (equal? n 0) 0 (let ((m (- n 1))) (+ n (sum-to m)))))", frame)
+    run("(define (make-adder n) (lambda (x) (+ x n)))", frame)
+    run("(define (counter n) (begin (define count n) "
+        "(lambda () (begin (set! count (+ count 1)) count))))", frame)
+    run("(define (swap-sum a b) (begin (set! a (+ a b)) (let ((b a)) (begin (set! b (* b 2)) b))))", frame)
+
+    assert lab.captures_frame(lab.parse(lab.tokenize("(let ((x 1)) (map (lambda (y) y) x))")))
+    assert not lab.captures_frame(lab.parse(lab.tokenize("(let ((x 1)) (map car x))")))
+    assert run("fib", frame).pool is not None
+    assert run("make-adder", frame).pool is None and run("counter", frame).pool is None
+
+    assert run("(fib 15)", frame) == 610
+    assert len(run("fib", frame).pool) <= lab.FRAME_POOL_SIZE
+    assert run("(sum-to 2000)", frame) == 2001000
+    assert run("(swap-sum 1 2)", frame) == 6
+    assert run("(swap-sum 3 4)", frame) == 14
+
+    # pooled frames don't hold on to arguments or parents between calls
+    run("(define (size l) (length l))", frame)
+    assert run("(size (range 1000))", frame) == 1000
+    pool = run("size", frame).pool
+    assert pool and all(f.slots is None and f.parent is None for f in pool)
+    lab.start_profiling()
+    try:
+        assert run("(size (range 10))", frame) == 10
+        assert all(f.slots is None for f in run("size", frame).pool)
+    finally:
+        lab.stop_profiling()
+
+    # frames that escape into closures are never reused
+    run("(define add1 (make-adder 1))", frame)
+    run("(define add2 (make-adder 2))", frame)
+    assert (run("(add1 10)", frame), run("(add2 10)", frame)) == (11, 12)
+    run("(define c (counter 5))", frame)
+    assert (run("(c)", frame), run("(c)", frame), run("(fib 10)", frame), run("(c)", frame)) == (6, 7, 55, 8)
+
+
+def test_tail_calls_constant_stack():
+    frame = lab.make_initial_frame()
+    for line in [
+        "(define (loop n acc) (if (equal? n 0) acc (let ((m (- n 1))) (begin (loop m (+ acc 1))))))",
+        "(define (even? n) (if (equal? n 0) #t (odd? (- n 1))))",
+        "(define (odd? n) (if (equal? n 0) #f (even? (- n 1))))",
+    ]:
+        run(line, frame)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(200)
+    try:
+        assert run("(loop 50000 0)", frame) == 50000
+        assert run("(even? 50001)", frame) is False
+    finally:
+        sys.setrecursionlimit(limit)
+
+
 def test_deep_nesting_1():
     do_raw_continued_evaluations(58)
 
@@ -714,3 +1157,344 @@ def test_sudoku_solver():
         initial_frame
     )
     do_raw_continued_evaluations(66, initial_frame)
+
+
+def test_sudoku_vectors():
+    puzzle = """(define puzzle (list
+      (list 5 1 7 6 0 8 2 3 4) (list 2 8 9 0 3 4 7 5 6) (list 3 4 6 2 7 5 8 9 1)
+      (list 6 7 2 8 4 9 3 1 5) (list 1 3 8 5 2 6 9 4 7) (list 9 5 4 7 1 3 6 0 2)
+      (list 4 9 5 3 6 2 1 7 8) (list 7 2 3 4 8 1 5 6 9) (list 8 0 1 9 5 7 4 2 0)))"""
+    solutions = []
+    for solver in ["sudoku.scm", "sudoku_vectors.scm"]:
+        frame = lab.make_initial_frame()
+        lab.evaluate_file(MFR_FILE, frame)
+        lab.evaluate_file(os.path.join(TEST_DIRECTORY, "test_files", solver), frame)
+        run(puzzle, frame)
+        solutions.append(run("(solve-sudoku puzzle)", frame))
+    assert solutions[0] == solutions[1]
+    assert solutions[1].car == lab.create_list(5, 1, 7, 6, 9, 8, 2, 3, 4)
+    # board4 has no solution, which the vector solver finds by backtracking
+    assert run("(solve-sudoku board4)", frame) == -1
+
+
+# TESTS FOR PROFILING AND BUDGETS
+
+
+def test_profiler():
+    frame = lab.make_initial_frame()
+    for line in [
+        "(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))",
+        "(define loop (lambda (n) (if (equal? n 0) 0 (loop (- n 1)))))",
+    ]:
+        run(line, frame)
+    unprofiled = lab.Function.__call__
+
+    profiler = lab.start_profiling()
+    try:
+        assert run("(fib 10)", frame) == 55
+        assert run("(loop 1000)", frame) == 0
+        with pytest.raises(lab.SchemeEvaluationError):
+            run("(loop 1 2)", frame)
+    finally:
+        assert lab.stop_profiling() is profiler
+    assert lab.Function.__call__ is unprofiled
+    assert lab.GLOBAL_FRAME.namespace["+"] is lab.scheme_builtins["+"]
+
+    assert profiler.stack == []
+    assert profiler.stats["fib"][0] == 177
+    assert profiler.stats["loop"][0] == 1001  # every tail call counts
+    assert profiler.stats["<"][0] == 177
+    for calls, cumulative, own in profiler.stats.values():
+        assert 0 <= own <= cumulative
+
+    stacks = profiler.collapsed_stacks()
+    assert "fib;fib;fib;<" in stacks
+    assert "loop" in stacks and "loop;loop" not in stacks
+    assert lab.stop_profiling() is None
+
+
+def test_budget():
+    frame = lab.make_initial_frame()
+    for line in [
+        "(define (loop n) (loop (+ n 1)))",
+        "(define (build n acc) (if (equal? n 0) acc (build (- n 1) (cons n acc))))",
+    ]:
+        run(line, frame)
+
+    budget = lab.Budget(max_steps=1000)
+    with pytest.raises(lab.SchemeBudgetError):
+        run("(loop 0)", frame, budget)
+    assert budget.steps == 1001
+    assert run("(length (build 999 (list)))", frame, budget) == 999  # counts start over
+    assert (budget.steps, budget.pairs) == (1000, 999)
+
+    budget = lab.Budget(max_pairs=500)
+    with pytest.raises(lab.SchemeBudgetError):
+        run("(build 1000 (list))", frame, budget)
+    assert budget.pairs == 501
+
+    # builtins that allocate in bulk fail before doing the work
+    budget = lab.Budget(max_pairs=10, timeout=0.5)
+    start = time.perf_counter()
+    for line in [
+        "(range 20000000)",
+        "(make-vector 200000000 0)",
+        "(expt 10 1000000)",  # more bits than MAX_INT_BITS
+        "(append (list 1 2 3 4 5 6) (list 7 8 9 10 11))",
+        "(map car (list (list 1) (list 2) (list 3) (list 4) (list 5) (list 6)))",
+    ]:
+        with pytest.raises(lab.SchemeBudgetError):
+            run(line, frame, budget)
+    assert time.perf_counter() - start < 0.5
+    assert run("(expt 10 100)", frame, budget) == 10 ** 100
+    assert run("(range 1 2 0.25)", frame, budget) == lab.create_list(1, 1.25, 1.5, 1.75)
+
+    # big integers are limited by size even with only a timeout, since one
+    # multiplication can't be interrupted
+    run("(define (square-up x n) (if (equal? n 0) (equal? x 0) (square-up (* x x) (- n 1))))", frame)
+    start = time.perf_counter()
+    with pytest.raises(lab.SchemeBudgetError):
+        run("(square-up 3 25)", frame, lab.Budget(max_steps=1000, max_pairs=1000, timeout=0.5))
+    with pytest.raises(lab.SchemeBudgetError):
+        run("(expt 3 30000000)", frame, lab.Budget(timeout=0.05))
+    assert time.perf_counter() - start < 2
+    with pytest.raises(lab.SchemeBudgetError):
+        run("(* (expt 2 600) (expt 2 600))", frame, lab.Budget(max_int_bits=1000))
+    assert run("(expt 1 100000000)", frame, lab.Budget(max_int_bits=1000)) == 1
+    assert run("(expt 2 10000)", frame, lab.Budget(max_int_bits=None)) == 2 ** 10000
+
+    # and builtins that only loop still watch the clock
+    big = lab.create_list(*range(300000))
+    lab.create_variable("big", big, frame)
+    budget = lab.Budget(timeout=0.05)
+    with pytest.raises(lab.SchemeBudgetError):
+        run("(reduce (lambda (a b) a) (append big big big big big big big big big big) 0)", frame, budget)
+    with pytest.raises(lab.SchemeBudgetError):
+        run("(range 20000000)", frame, budget)
+
+    budget = lab.Budget(timeout=0.2)
+    start = time.perf_counter()
+    with pytest.raises(lab.SchemeBudgetError):
+        run("(loop 0)", frame, budget)
+    assert 0.2 <= time.perf_counter() - start < 2
+    # the time left from one with block doesn't carry into the next
+    budget = lab.Budget(timeout=0.05)
+    assert run("(length (build 10 (list)))", frame, budget) == 10
+    time.sleep(0.1)
+    assert run("(length (build 10 (list)))", frame, budget) == 10
+    assert not lab.WATCHDOG.entries
+
+    # nothing is left installed once budgets are done, however the threads
+    # using them interleave: here A enters, B enters, A exits, B exits
+    entered, exited = threading.Event(), threading.Event()
+    def thread_b():
+        with lab.Budget(max_steps=10):
+            entered.set()
+            exited.wait()
+            with pytest.raises(lab.SchemeBudgetError):
+                run("(loop 0)", frame)
+    with lab.Budget(max_steps=10):
+        b = threading.Thread(target=thread_b)
+        b.start()
+        entered.wait()
+    exited.set()
+    b.join()
+    assert lab.current_budget() is None and lab.ACTIVE_BUDGETS == 0
+    assert run("(length (build 2000 (list)))", frame) == 2000
+
+    directory = tempfile.mkdtemp()
+    try:
+        script = os.path.join(directory, "script.scm")
+        with open(script, "w") as f:
+            f.write("(define (loop n) (loop (+ n 1)))\n(loop 0)\n")
+        with pytest.raises(lab.SchemeBudgetError):
+            lab.evaluate_file(script, budget=lab.Budget(max_steps=100))
+    finally:
+        shutil.rmtree(directory)
+
+    repl = schemerepl.SchemeREPL(lab, use_frames=True, repl_frame=frame, budget=lab.Budget(max_steps=100))
+    output = io.StringIO()
+    sys.stdout, stdout = output, sys.stdout
+    try:
+        repl.onecmd("(loop 0)")
+        repl.onecmd("(length (build 50 (list)))")
+    finally:
+        sys.stdout = stdout
+    assert "EXCEPTION" in output.getvalue() and "out> 50" in output.getvalue()
+
+
+# TESTS FOR MEMOIZATION, FOLDING AND PMAP
+
+
+def test_define_memo():
+    frame = lab.make_initial_frame()
+    run("(define-memo (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))", frame)
+    assert run("(fib 300)", frame) == 222232244629420445529739893461909967206666939096499764990979600
+    assert run("(memo-misses fib)", frame) == 301  # each argument computed once
+    assert run("(memo-hits fib)", frame) == 298
+    assert run("(fib 300)", frame) == 222232244629420445529739893461909967206666939096499764990979600
+    assert run("(memo-hits fib)", frame) == 299
+
+    # least recently used results are evicted past the size limit
+    run("(define calls 0)", frame)
+    run("(define-memo (square x) (begin (set! calls (+ calls 1)) (* x x)) 2)", frame)
+    assert [run(f"(square {x})", frame) for x in (1, 2, 1, 3, 1, 2)] == [1, 4, 1, 9, 1, 4]
+    assert run("calls", frame) == 4
+    assert (run("(memo-hits square)", frame), run("(memo-misses square)", frame)) == (2, 4)
+
+    # keyed by value and type: equal lists share an entry, 1 and #t don't
+    run("(define count (memoize (lambda (x) (begin (set! calls (+ calls 1)) calls))))", frame)
+    assert run("(count (list 1 2 3))", frame) == run("(count (list 1 2 3))", frame)
+    assert run("(count 1)", frame) != run("(count #t)", frame)
+    assert run("(count (vector 1))", frame) != run("(count (vector 1))", frame)  # vectors aren't cached
+    # ... all the way down
+    run("(define-memo (head l) (car l))", frame)
+    assert [run(f"(head (list {x}))", frame) for x in ("1", "#t", "1.0")] == [1, True, 1.0]
+    assert [type(run(f"(head (list {x}))", frame)) for x in ("1", "#t", "1.0")] == [int, bool, float]
+    assert run("(count (list (vector 1)))", frame) != run("(count (list (vector 1)))", frame)
+    # nor are hash tables, which can change between calls
+    run("(define h (make-hash))", frame)
+    run("(define-memo (size t) (hash-count t))", frame)
+    assert run("(size h)", frame) == 0
+    run("(hash-set! h 1 1)", frame)
+    assert run("(size h)", frame) == 1
+    assert str(run("(count 0.0)", frame)) != str(run("(count -0.0)", frame))
+
+    for bad in ["(define-memo fib 1)", "(define-memo (f) 1 0)", "(memoize 1)", "(memo-hits car)",
+                "(define-memo (g x) x (* 1e308 10))"]:
+        with pytest.raises(lab.SchemeEvaluationError):
+            run(bad, frame)
+
+
+def test_fold_constants():
+    def fold(source, frame=None):
+        return lab.fold_constants(lab.parse(lab.tokenize(source)), frame)
+
+    assert fold("(+ 1 2 (* 3 4))") == (15, 2)
+    assert fold("(if #t a b)") == ("a", 1)
+    assert fold("(if (< 2 1) (f (- 5 1)) x)") == ("x", 3)
+    assert fold("(lambda (x) (if (not #f) (+ x (* 2 3)) 0))") == (["lambda", ["x"], ["+", "x", 6]], 3)
+    assert fold("(and x #t (equal? 1 2) y)") == (["and", "x", "#f"], 2)
+    assert fold("(or #f (> 2 1) y)") == ("#t", 2)
+    assert fold("(let ((x (- 3))) (* x (/ 4 2)))") == (["let", [["x", -3]], ["*", "x", 2.0]], 2)
+    assert fold("(/ 1 0)") == (["/", 1, 0], 0)
+    assert fold("(+ 1 x)") == (["+", 1, "x"], 0)
+    assert fold("(define (f x) x)") == (["define", ["f", "x"], "x"], 0)
+
+    # anything that rebinds a builtin's name keeps it from being folded
+    assert fold("(define (f +) (+ 1 2))") == (["define", ["f", "+"], ["+", 1, 2]], 0)
+    assert fold("(begin (set! * +) (* 2 2) (- 2 2))") == (["begin", ["set!", "*", "+"], ["*", 2, 2], 0], 1)
+    assert fold("(let ((< >)) (< 1 2))") == (["let", [["<", ">"]], ["<", 1, 2]], 0)
+    frame = lab.make_initial_frame()
+    run("(define + -)", frame)
+    assert fold("(+ 5 1)", frame) == (["+", 5, 1], 0)
+    assert fold("(+ 5 1)") == (6, 1)
+
+    trees = [lab.parse(lab.tokenize(line)) for line in ["(define (f) (+ 1 2))", "(define + *)", "(f)"]]
+    folded, count = lab.fold_program(trees)
+    assert count == 0
+    frame = lab.make_initial_frame()
+    assert [lab.evaluate(tree, frame) for tree in folded][-1] == 2
+
+    # with --fold, a file that rebinds + keeps earlier files from folding it
+    directory = tempfile.mkdtemp()
+    try:
+        files = []
+        for name, source in [("uses.scm", "(define (f) (+ 2 3))"), ("rebinds.scm", "(define (+ a b) (* a b))")]:
+            files.append(os.path.join(directory, name))
+            with open(files[-1], "w") as f:
+                f.write(source + "\n")
+        result = subprocess.run(
+            [sys.executable, "lab.py", "--fold", *files], input="(f)\n",
+            cwd=TEST_DIRECTORY, capture_output=True, text=True, timeout=30,
+        )
+        assert "out> 6" in result.stdout
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_pmap_matches_map():
+    frame = lab.make_initial_frame()
+    run("(define k 10)", frame)
+    run("(define (make-adder n) (lambda (x) (+ x n k)))", frame)
+    run("(define (make-scaler n) (begin (define m (* n 2)) (lambda (x) (* x m))))", frame)
+    for func in [
+        "(make-adder 5)",  # closes over a SlotFrame and the top-level Frame
+        "(make-scaler 3)",  # closes over a dict Frame
+        "(lambda (l) (if (list? l) (length l) (vector-length l)))",
+        "(lambda (x) (make-adder x))",
+        "-",
+    ]:
+        for elems in ["(range 50)", "(list 3)", "(list)", "(list (list 1 2) (list) (vector 1 2 3))"]:
+            try:
+                expected = str(run(f"(map {func} {elems})", frame))
+            except Exception as e:
+                expected = type(e)
+            try:
+                result = str(run(f"(pmap {func} {elems})", frame))
+            except Exception as e:
+                result = type(e)
+            assert result == expected, (func, elems)
+
+    # closures returned from the workers still work here
+    assert list_from_ll(run("(map (lambda (add) (add 1)) (pmap make-adder (range 3)))", frame)) == \
+        list_from_ll(lab.create_list(11, 12, 13))
+
+    # the error raised is the one for the first element that fails
+    with pytest.raises(lab.SchemeEvaluationError):
+        run("(pmap (lambda (x) (if (equal? x 40) (car 1) (if (equal? x 45) (undefined) x))) (range 50))", frame)
+    with pytest.raises(lab.SchemeNameError):
+        run("(pmap (lambda (x) (if (equal? x 40) (car 1) (if (equal? x 5) (undefined) x))) (range 50))", frame)
+    with pytest.raises(lab.SchemeEvaluationError):
+        run("(pmap 1 (range 3))", frame)
+
+    # under a budget, pmap maps here so the limits still hold, and workers
+    # never inherit a budget
+    run("(define (spin n) (if (equal? n 0) 0 (spin (- n 1))))", frame)
+    with pytest.raises(lab.SchemeBudgetError):
+        run("(pmap spin (list 100000 100000))", frame, lab.Budget(max_steps=10_000, timeout=1))
+    assert run("(pmap spin (list 200000 200000))", frame) == lab.create_list(0, 0)
+
+
+# TESTS FOR INTERPRETERS
+
+
+def test_interpreters():
+    directory = tempfile.mkdtemp()
+    try:
+        prelude = os.path.join(directory, "prelude.scm")
+        with open(prelude, "w") as f:
+            f.write("(define count 0)\n(define (bump!) (set! count (+ count 1)))\n(set! modulo expt)\n")
+        base = lab.make_base(MFR_FILE, prelude)
+    finally:
+        shutil.rmtree(directory)
+
+    a, b = lab.Interpreter(base), lab.Interpreter(base)
+    assert a.run("(set! + *) (+ 5 3)") == 15 and b.run("(+ 5 3)") == 8
+    assert a.run("(modulo 2 3)") == 8  # rebound in the prelude's own frame
+    assert lab.evaluate(["+", 5, 3]) == 8 and lab.Interpreter().run("(modulo 2 3)") == 2
+    a.run("(define x 1)")
+    with pytest.raises(lab.SchemeNameError):
+        b.run("x")
+    assert a.run("(set! count 5) count") == 5 and b.run("count") == 0
+    assert b.run("(reduce + (map (lambda (x) (* x x)) (list 1 2 3)) 0)") == 14
+    # the prelude's own functions set! and read the calling session's copy
+    assert b.run("(bump!) (bump!) count") == 2 and a.run("count") == 5
+    assert lab.Interpreter(base).run("(bump!)") == 1
+    assert a.run("(bump!) count") == 5  # + is * in a, for the prelude's code too
+    with pytest.raises(lab.SchemeEvaluationError, match="count"):
+        lab.evaluate(["bump!"], lab.Frame(base))  # not in any session
+    with pytest.raises(lab.SchemeNameError):
+        b.run("(del count)")
+    with pytest.raises(lab.SchemeEvaluationError):
+        lab.create_variable("x", 1, base)
+
+    def session(i):
+        interpreter = lab.Interpreter(base)
+        return interpreter.run(
+            f"(define k {i}) (set! * +)"
+            "(define (g n) (if (equal? n 0) 0 (* k (g (- n 1)))))"
+            "(g 50)"
+        )
+    with ThreadPoolExecutor(8) as executor:
+        assert list(executor.map(session, range(200))) == [50 * i for i in range(200)]
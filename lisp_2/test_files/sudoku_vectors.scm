@@ -0,0 +1,155 @@
+; sudoku solver from sudoku.scm, ported to vectors :)
+
+; the board is a vector of row vectors.  cells are filled in place with
+; vector-set! and reset to 0 when backtracking, so reading or writing a cell is
+; constant time instead of two list-ref walks plus a rebuilt board per move.
+;   (solve-sudoku board)
+; takes a board as a list of lists (like sudoku.scm) and returns the solved
+; board as a list of lists, or -1 if the board can't be solved.
+; needs map from map_filter_reduce.scm.
+
+
+(begin
+    (define (list->board rows) (list->vector (map list->vector rows)))
+    (define (board->list board) (map vector->list (vector->list board)))
+
+    (define (board-ref board r c) (vector-ref (vector-ref board r) c))
+    (define (board-set! board r c elt) (vector-set! (vector-ref board r) c elt))
+
+    ; this would be easier if we had floor division, but...oh well
+    (define (third x) (if (< x 3) 0 (if (< x 6) 1 2)))
+    (define (subgrid-start x) (* 3 (third x)))
+
+    ; is (pred i) true for some i with start <= i < stop?
+    (define (any-index? pred i stop)
+        (if (>= i stop)
+            #f
+            (if (pred i)
+                #t
+                (any-index? pred (+ i 1) stop)
+            )
+        )
+    )
+
+    (define (valid-move? board r c elt)
+        (let ((sr (subgrid-start r)) (sc (subgrid-start c)))
+            (not
+                (any-index?
+                    (lambda (i)
+                        (or (equal? (board-ref board r i) elt)
+                            (equal? (board-ref board i c) elt)
+                            (equal? (board-ref board
+                                               (+ sr (third i))
+                                               (+ sc (- i (* 3 (third i)))))
+                                    elt)
+                        )
+                    )
+                    0 9
+                )
+            )
+        )
+    )
+
+    (define (find-first-zero board r c)
+        (if (>= r 9)
+            (cons -1 -1)
+            (if (>= c 9)
+                (find-first-zero board (+ r 1) 0)
+                (if (equal? (board-ref board r c) 0)
+                    (cons r c)
+                    (find-first-zero board r (+ c 1))
+                )
+            )
+        )
+    )
+
+    (define (try-moves board r c elt)
+        (if (> elt 9)
+            (begin (board-set! board r c 0) #f) ; undo, signal failure
+            (if (valid-move? board r c elt)
+                (begin
+                    (board-set! board r c elt)
+                    (if (solve! board)
+                        #t
+                        (begin (board-set! board r c 0) (try-moves board r c (+ elt 1)))
+                    )
+                )
+                (try-moves board r c (+ elt 1))
+            )
+        )
+    )
+
+    (define (solve! board)
+        (let ((zero-ix (find-first-zero board 0 0)))
+            (if (equal? (car zero-ix) -1)
+                #t ; omg solved!
+                (try-moves board (car zero-ix) (cdr zero-ix) 1)
+            )
+        )
+    )
+
+    (define (solve-sudoku rows)
+        (let ((board (list->board rows)))
+            (if (solve! board)
+                (board->list board)
+                -1
+            )
+        )
+    )
+
+    (define board1
+         (list
+            (list 5 1 7 6 0 0 0 3 4)
+            (list 2 8 9 0 0 4 0 0 0)
+            (list 3 4 6 2 0 5 0 9 0)
+            (list 6 0 2 0 0 0 0 1 0)
+            (list 0 3 8 0 0 6 0 4 7)
+            (list 0 0 0 0 0 0 0 0 0)
+            (list 0 9 0 0 0 0 0 7 8)
+            (list 7 0 3 4 0 0 5 6 0)
+            (list 0 0 0 0 0 0 0 0 0)
+        )
+    )
+
+    (define board2
+         (list
+            (list 5 1 7 6 0 0 0 3 4)
+            (list 0 8 9 0 0 4 0 0 0)
+            (list 3 0 6 2 0 5 0 9 0)
+            (list 6 0 0 0 0 0 0 1 0)
+            (list 0 3 0 0 0 6 0 4 7)
+            (list 0 0 0 0 0 0 0 0 0)
+            (list 0 9 0 0 0 0 0 7 8)
+            (list 7 0 3 4 0 0 5 6 0)
+            (list 0 0 0 0 0 0 0 0 0)
+         )
+    )
+
+    (define board3
+        (list
+            (list 0 0 1 0 0 9 0 0 3)
+            (list 0 8 0 0 2 0 0 9 0)
+            (list 9 0 0 1 0 0 8 0 0)
+            (list 1 0 0 5 0 0 4 0 0)
+            (list 0 7 0 0 3 0 0 5 0)
+            (list 0 0 6 0 0 4 0 0 7)
+            (list 0 0 8 0 0 5 0 0 6)
+            (list 0 3 0 0 7 0 0 4 0)
+            (list 2 0 0 3 0 0 9 0 0)
+        )
+    )
+
+    (define board4
+         (list
+            (list 5 1 7 6 8 0 0 3 4)
+            (list 2 8 9 0 0 4 0 0 0)
+            (list 3 4 6 2 0 5 0 9 0)
+            (list 6 0 2 0 0 0 0 1 0)
+            (list 0 3 8 0 0 6 0 4 7)
+            (list 0 0 0 0 0 0 0 0 0)
+            (list 0 9 0 0 0 0 0 7 8)
+            (list 7 0 3 4 0 0 5 6 0)
+            (list 0 0 0 0 0 0 0 0 0)
+        )
+    )
+)
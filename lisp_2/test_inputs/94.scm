@@ -0,0 +1,24 @@
+(define x 10)
+(define (f y) (lambda (z) (begin (set! y (+ y z)) y)))
+(define g (f 1))
+(g 5)
+(g 5)
+(define (h a) (begin (define b (* a 2)) (let ((c 3)) (+ a b c x))))
+(h 1)
+(define (k a) (let ((a 5)) (begin (del a) a)))
+(k 1)
+(define (m q) (let ((r 1)) (lambda () (begin (set! x (+ x q r)) x))))
+((m 2))
+x
+(define (n a) (let ((b 1)) (begin (define a 7) (lambda () (+ a b)))))
+((n 1))
+(define (p a a) a)
+(p 1 2)
+(define (s v) (let ((w v)) (lambda (u) (begin (set! w (+ w u)) (set! v (* v 2)) (list w v)))))
+(define t (s 3))
+(t 1)
+(t 1)
+(set! nothere 1)
+(define (q) undefined-name)
+(q)
+(let ((x 1) (y 2)) (let ((x 3)) (+ x y)))